@@ -0,0 +1,478 @@
+"""
+materialized per customer invoice count and amount total, kept in
+customer_invoice_totals and maintained incrementally: dashboards read one row
+per customer instead of grouping the whole invoices table
+
+    TOTALS.create(engine)                   # once, on an existing db: table and full rebuild
+    TOTALS.install(engine)                  # deltas from ORM flushes and Core inserts
+    TOTALS.totals(session)                  # (id, name, invoices, amount) per customer
+    TOTALS.check(engine)                    # [] when the table matches the invoices
+
+maintained:
+    ORM flushes, inserts, updates and deletes of Invoice and deletes of Customers
+    ORM bulk updates and deletes of Invoice: Query.update/delete, session.execute(update(Invoice))
+    Core statements on the invoices Table: inserts, executemany included (unitofwork.BulkWriter,
+    bulk_insert_mappings), updates and deletes (mutations.bulk_update/bulk_delete)
+not maintained, rebuild() after them:
+    sql strings, as exec_driver_sql and mutations.METHOD_JOIN, and raw DBAPI cursors, which no
+    event sees; ORM update(Invoice)/delete(Invoice) executed on a Connection instead of a Session;
+    INSERT ... SELECT, multi row VALUES; writes of other processes
+"""
+import collections
+
+import sqlalchemy
+from sqlalchemy.dialects import sqlite
+
+from models import Customers, Invoice
+
+Mismatch = collections.namedtuple("Mismatch", "custid invoices amount stored_invoices stored_amount")
+
+metadata = sqlalchemy.MetaData()
+customer_invoice_totals = sqlalchemy.Table(
+    "customer_invoice_totals", metadata,
+    sqlalchemy.Column("custid", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("invoices", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("amount", sqlalchemy.Integer, nullable=False),
+)
+
+IN_CHUNK = 500      # ids per IN (...), below the sqlite variables limit
+
+
+class InvoiceTotals:
+    """
+    count and sum of Invoice.amount per Invoice.custid, invoices without custid left out
+
+    deltas of a flush are applied at its end, in its transaction; Core inserts
+    outside a flush are applied right after each statement, in its transaction;
+    bulk updates and deletes select the invoices they match beforehand, one
+    SELECT per parameter set, and recompute the rows of their customers after
+    """
+
+    def __init__(self, table=customer_invoice_totals):
+        self.table = table
+        self.invoices = Invoice.__table__
+        self.flushing = {}      # Connection: (Session, deltas) of the flushes in progress
+        self.matched = {}       # (Connection, statement): (invoice ids, custids) of the Core updates/deletes running
+
+    #
+    #   schema
+    #
+    def create(self, bind):
+        """
+        creates the table, if missing, and fills it from the invoices
+
+        :param bind: Engine, or Connection in a transaction
+        :return:
+        """
+        if isinstance(bind, sqlalchemy.engine.Engine):
+            with bind.begin() as connection:
+                return self.create(connection)
+        self.table.create(bind, checkfirst=True)
+        self.rebuild(bind)
+
+    def grouped(self):
+        # the aggregation the table materializes, a full read of invoices
+        invoices = self.invoices
+        return sqlalchemy.select(
+            invoices.c.custid,
+            sqlalchemy.func.count().label("invoices"),
+            sqlalchemy.func.coalesce(sqlalchemy.func.sum(invoices.c.amount), 0).label("amount"),
+        ).where(invoices.c.custid.is_not(None)).group_by(invoices.c.custid)
+
+    def rebuild(self, connection):
+        """
+        recomputes every row, after writes the deltas do not cover
+
+        :param connection: Connection in a transaction
+        :return: number of rows
+        """
+        connection.execute(self.table.delete())
+        result = connection.execute(
+            self.table.insert().from_select(["custid", "invoices", "amount"], self.grouped())
+        )
+        return result.rowcount
+
+    def check(self, bind):
+        """
+        rows of the table that differ from a full GROUP BY of the invoices,
+        a missing row counting as 0 invoices and 0 amount
+
+        :param bind: Session, Connection or Engine
+        :return: list of Mismatch
+        """
+        if isinstance(bind, sqlalchemy.engine.Engine):
+            with bind.connect() as connection:
+                return self.check(connection)
+        expected = {row.custid: (row.invoices, row.amount) for row in bind.execute(self.grouped())}
+        stored = {row.custid: (row.invoices, row.amount) for row in bind.execute(self.table.select())}
+        mismatches = []
+        for custid in sorted(expected.keys() | stored.keys()):
+            invoices, amount = expected.get(custid, (0, 0))
+            stored_invoices, stored_amount = stored.get(custid, (0, 0))
+            if (invoices, amount) != (stored_invoices, stored_amount):
+                mismatches.append(Mismatch(custid, invoices, amount, stored_invoices, stored_amount))
+        return mismatches
+
+    def refresh(self, connection, custids):
+        """
+        recomputes the rows of custids
+
+        :param connection: Connection in a transaction
+        :param custids:
+        :return:
+        """
+        custids = sorted(custid for custid in set(custids) if custid is not None)
+        for start in range(0, len(custids), IN_CHUNK):
+            chunk = custids[start:start + IN_CHUNK]
+            connection.execute(self.table.delete().where(self.table.c.custid.in_(chunk)))
+            connection.execute(self.table.insert().from_select(
+                ["custid", "invoices", "amount"], self.grouped().where(self.invoices.c.custid.in_(chunk))
+            ))
+
+    def custids_of(self, bind, ids):
+        """
+        custids of the invoices ids, read in chunks
+
+        :param bind: Session or Connection
+        :param ids:
+        :return: set
+        """
+        invoices = self.invoices
+        custids = set()
+        for start in range(0, len(ids), IN_CHUNK):
+            custids.update(bind.execute(
+                sqlalchemy.select(invoices.c.custid).where(invoices.c.id.in_(ids[start:start + IN_CHUNK]))
+            ).scalars())
+        return custids
+
+    #
+    #   reads
+    #
+    def statement(self):
+        """
+        (id, name, invoices, amount) of every customer, one row read per customer
+        """
+        customers, totals = Customers.__table__, self.table
+        return sqlalchemy.select(
+            customers.c.id,
+            customers.c.name,
+            sqlalchemy.func.coalesce(totals.c.invoices, 0).label("invoices"),
+            sqlalchemy.func.coalesce(totals.c.amount, 0).label("amount"),
+        ).join_from(customers, totals, totals.c.custid == customers.c.id, isouter=True).order_by(customers.c.id)
+
+    def totals(self, bind):
+        """
+        :param bind: Session, Connection or Engine
+        :return: list of rows, see statement()
+        """
+        if isinstance(bind, sqlalchemy.engine.Engine):
+            with bind.connect() as connection:
+                return connection.execute(self.statement()).all()
+        return bind.execute(self.statement()).all()
+
+    #
+    #   deltas
+    #
+    def apply(self, connection, deltas):
+        """
+        adds the deltas to the table, creating the missing rows
+
+        :param connection: Connection in a transaction
+        :param deltas: {custid: [invoices, amount]}
+        :return:
+        """
+        rows = [
+            dict(custid=custid, invoices=invoices, amount=amount)
+            for custid, (invoices, amount) in deltas.items()
+            if custid is not None and (invoices or amount)
+        ]
+        if not rows:
+            return
+        insert = sqlite.insert(self.table)
+        connection.execute(insert.on_conflict_do_update(
+            index_elements=[self.table.c.custid],
+            set_=dict(
+                invoices=self.table.c.invoices + insert.excluded.invoices,
+                amount=self.table.c.amount + insert.excluded.amount,
+            )
+        ), rows)
+
+    @staticmethod
+    def add(deltas, custid, invoices, amount):
+        delta = deltas.setdefault(custid, [0, 0])
+        delta[0] += invoices
+        delta[1] += amount or 0
+
+    #
+    #   events
+    #
+    def install(self, engine=sqlalchemy.engine.Engine, session=sqlalchemy.orm.Session):
+        sqlalchemy.event.listen(engine, "before_execute", self.before_execute)
+        sqlalchemy.event.listen(engine, "after_execute", self.after_execute)
+        sqlalchemy.event.listen(engine, "handle_error", self.handle_error)
+        sqlalchemy.event.listen(session, "before_flush", self.before_flush)
+        sqlalchemy.event.listen(session, "after_flush", self.after_flush)
+        sqlalchemy.event.listen(session, "after_soft_rollback", self.after_soft_rollback)
+        sqlalchemy.event.listen(session, "do_orm_execute", self.do_orm_execute)
+        return self
+
+    def remove(self, engine=sqlalchemy.engine.Engine, session=sqlalchemy.orm.Session):
+        sqlalchemy.event.remove(engine, "before_execute", self.before_execute)
+        sqlalchemy.event.remove(engine, "after_execute", self.after_execute)
+        sqlalchemy.event.remove(engine, "handle_error", self.handle_error)
+        sqlalchemy.event.remove(session, "before_flush", self.before_flush)
+        sqlalchemy.event.remove(session, "after_flush", self.after_flush)
+        sqlalchemy.event.remove(session, "after_soft_rollback", self.after_soft_rollback)
+        sqlalchemy.event.remove(session, "do_orm_execute", self.do_orm_execute)
+
+    def do_orm_execute(self, orm_execute_state):
+        # Query.update/delete and session.execute(update(Invoice)); their statements reach the
+        # engine events on an annotated copy of the table, which before_execute leaves alone
+        if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+            return None
+        mapper = orm_execute_state.bind_arguments.get("mapper")
+        if mapper is None or not mapper.isa(sqlalchemy.inspect(Invoice)):
+            return None
+
+        session, statement = orm_execute_state.session, orm_execute_state.statement
+        ids, custids = [], set()
+        for invoice_id, custid in session.execute(
+                sqlalchemy.select(Invoice.id, Invoice.custid).where(statement.whereclause),
+                orm_execute_state.parameters
+        ):
+            ids.append(invoice_id)
+            custids.add(custid)
+        result = orm_execute_state.invoke_statement()
+        if orm_execute_state.is_update:
+            custids |= self.custids_of(session, ids)
+        self.refresh(session.connection(bind_arguments=dict(mapper=mapper)), custids)
+        return result
+
+    def before_execute(self, conn, clauseelement, multiparams, params, execution_options):
+        # Core updates and deletes of invoices, the ones of a flush are left to after_flush
+        if not isinstance(clauseelement, (sqlalchemy.sql.Update, sqlalchemy.sql.Delete)):
+            return
+        if clauseelement.table is not self.invoices or conn in self.flushing:
+            return
+        invoices = self.invoices
+        select = sqlalchemy.select(invoices.c.id, invoices.c.custid).where(clauseelement.whereclause)
+        ids, custids = [], set()
+        # executemany, as mutations.bulk_update: the rows matched by each parameter set
+        for parameters in _parameter_sets(multiparams, params):
+            for invoice_id, custid in conn.execute(select, parameters):
+                ids.append(invoice_id)
+                custids.add(custid)
+        self.matched[(conn, clauseelement)] = (ids, custids)
+
+    def after_execute(self, conn, clauseelement, multiparams, params, execution_options, result):
+        matched = self.matched.pop((conn, clauseelement), None)
+        if matched is not None:
+            ids, custids = matched
+            if isinstance(clauseelement, sqlalchemy.sql.Update):
+                custids |= self.custids_of(conn, ids)
+            self.refresh(conn, custids)
+            return
+
+        # inserts into invoices, the ORM ones included: buffered during a flush, applied at once otherwise
+        if not isinstance(clauseelement, sqlalchemy.sql.Insert) or clauseelement.table is not self.invoices:
+            return
+        if clauseelement.select is not None or clauseelement._multi_values:
+            return
+        deltas = {}
+        for parameters in result.context.compiled_parameters:
+            self.add(deltas, parameters.get("custid"), 1, parameters.get("amount"))
+        flushing = self.flushing.get(conn)
+        if flushing is not None:
+            for custid, (invoices, amount) in deltas.items():
+                self.add(flushing[1], custid, invoices, amount)
+        else:
+            self.apply(conn, deltas)
+
+    def handle_error(self, exception_context):
+        # a failed statement has no after_execute
+        for key in [key for key in self.matched if key[0] is exception_context.connection]:
+            del self.matched[key]
+
+    def before_flush(self, session, flush_context, instances):
+        changed = [
+            obj for obj in session.dirty
+            if isinstance(obj, Invoice) and session.is_modified(obj, include_collections=False)
+        ]
+        deleted = [obj for obj in session.deleted if isinstance(obj, (Invoice, Customers))]
+        if not changed and not deleted and not any(isinstance(obj, Invoice) for obj in session.new):
+            return
+
+        connection = session.connection(bind_arguments=dict(mapper=sqlalchemy.inspect(Invoice)))
+        deltas = {}
+        # the old values are read from the db: attributes set before being loaded have no history
+        old = [obj for obj in changed + deleted if isinstance(obj, Invoice)]
+        invoices = self.invoices
+        ids = [sqlalchemy.inspect(obj).identity[0] for obj in old]
+        for start in range(0, len(ids), IN_CHUNK):
+            for row in connection.execute(
+                    sqlalchemy.select(invoices.c.custid, invoices.c.amount)
+                    .where(invoices.c.id.in_(ids[start:start + IN_CHUNK]))
+            ):
+                self.add(deltas, row.custid, -1, -(row.amount or 0))
+        session.info["invoice_totals"] = (changed, [obj.id for obj in deleted if isinstance(obj, Customers)])
+        self.flushing[connection] = (session, deltas)
+
+    def after_flush(self, session, flush_context):
+        if "invoice_totals" not in session.info:
+            return
+        changed, deleted_customers = session.info.pop("invoice_totals")
+        connection = session.connection(bind_arguments=dict(mapper=sqlalchemy.inspect(Invoice)))
+        flushing = self.flushing.pop(connection, None)
+        if flushing is None:
+            return
+        _, deltas = flushing
+        for obj in changed:
+            self.add(deltas, obj.custid, 1, obj.amount)
+        self.apply(connection, deltas)
+        # invoices of deleted customers are detached by the flush: custid set to NULL
+        if deleted_customers:
+            connection.execute(self.table.delete().where(self.table.c.custid.in_(deleted_customers)))
+
+    def after_soft_rollback(self, session, previous_transaction):
+        # a failed flush has no after_flush
+        session.info.pop("invoice_totals", None)
+        for connection, (flushing_session, _) in list(self.flushing.items()):
+            if flushing_session is session:
+                del self.flushing[connection]
+
+
+def _parameter_sets(multiparams, params):
+    # the parameters of Connection.execute as before_execute receives them: a list of
+    # dicts for an executemany, a dict, keyword arguments or nothing
+    if multiparams:
+        first = multiparams[0]
+        if isinstance(first, (list, tuple)):
+            return first or [{}]
+        return list(multiparams)
+    return [params or {}]
+
+
+TOTALS = InvoiceTotals()
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import shutil
+    import tempfile
+    import time
+
+    from sqlalchemy.orm import sessionmaker
+
+    import common
+    import fixtures
+    import mutations
+    from unitofwork import BulkWriter
+
+    parser = argparse.ArgumentParser(description="materialized invoice totals per customer")
+    parser.add_argument("command", nargs="?", choices=("demo", "rebuild", "check"), default="demo")
+    parser.add_argument("--db", help="database of rebuild and check")
+    parser.add_argument("--rows", type=int, default=20000, help="customers of the demo, 3 invoices each")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command != "demo":
+        if not args.db:
+            parser.error(f"{args.command} needs --db")
+        engine = common.create_sqlite_engine(args.db)
+        if args.command == "rebuild":
+            start = time.perf_counter()
+            with engine.begin() as connection:
+                TOTALS.table.create(connection, checkfirst=True)
+                rows = TOTALS.rebuild(connection)
+            print(f"{rows} rows in {time.perf_counter() - start:.3f}s")
+        else:
+            mismatches = TOTALS.check(engine)
+            for mismatch in mismatches:
+                print(mismatch)
+            print(f"{len(mismatches)} mismatches")
+            raise SystemExit(1 if mismatches else 0)
+        raise SystemExit(0)
+
+    directory = tempfile.mkdtemp(prefix="aggregates-")
+    filename = fixtures.clone("sales", os.path.join(directory, "sales.db"), args.rows)
+    engine = common.create_sqlite_engine(filename, profile=common.PROFILE_READ_HEAVY)
+    Session = sessionmaker(bind=engine)
+    try:
+        start = time.perf_counter()
+        TOTALS.create(engine)
+        print(f"rebuilt in {time.perf_counter() - start:.3f}s")
+        TOTALS.install(engine, Session)
+
+        customers = Customers.__table__
+        grouped = TOTALS.grouped().subquery()
+        dashboards = {
+            "group by": sqlalchemy.select(customers.c.id, customers.c.name, grouped.c.invoices, grouped.c.amount)
+            .join_from(customers, grouped, grouped.c.custid == customers.c.id, isouter=True).order_by(customers.c.id),
+            "materialized": TOTALS.statement(),
+        }
+        with engine.connect() as connection:
+            for name, statement in dashboards.items():
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    rows = connection.execute(statement).all()
+                elapsed = (time.perf_counter() - start) / args.repeat
+                print(f"{name:<12s} {elapsed * 1000:8.3f}ms {len(rows)} customers")
+
+        with Session() as session:
+            customer = Customers(name="Fab", address="meow street 9", email="fab@meow.com")
+            customer.invoices = [Invoice(invno=n, amount=n * 100) for n in range(1, 4)]
+            session.add(customer)
+            session.commit()
+            print("orm insert:", TOTALS.check(session))
+
+            invoice = session.get(Invoice, 1)
+            invoice.amount += 1000
+            moved = session.get(Invoice, 2)
+            moved.customer = customer
+            session.delete(session.get(Invoice, 3))
+            session.commit()
+            print("orm update, move, delete:", TOTALS.check(session))
+
+            session.delete(session.get(Customers, 2))
+            session.commit()
+            print("orm customer delete:", TOTALS.check(session))
+
+            with BulkWriter(session, chunk_size=1000) as writer:
+                for n in range(500):
+                    new = Customers(name=f"bulk{n}", address="", email="")
+                    new.invoices = [Invoice(invno=1, amount=n), Invoice(invno=2, amount=n)]
+                    writer.add(new)
+            session.commit()
+            session.execute(Invoice.__table__.insert(), [dict(custid=5, invno=9, amount=9)] * 10)
+            session.commit()
+            print("core inserts:", TOTALS.check(session))
+
+            session.execute(Invoice.__table__.update().where(Invoice.custid == 6).values(amount=0))
+            session.execute(Invoice.__table__.delete().where(Invoice.custid == 7))
+            session.commit()
+            print("core update, delete:", TOTALS.check(session))
+
+            session.query(Invoice).filter(Invoice.custid == 1).delete()
+            session.query(Invoice).filter(Invoice.custid == 8).update({"custid": 9}, synchronize_session="fetch")
+            session.commit()
+            print("orm bulk delete, update:", TOTALS.check(session))
+
+            invoice_ids = session.execute(
+                sqlalchemy.select(Invoice.id).where(Invoice.custid.in_([10, 11]))).scalars().all()
+            mutations.bulk_update(session, Invoice, [(invoice_id, dict(amount=1)) for invoice_id in invoice_ids])
+            mutations.bulk_delete(session, Invoice, session.execute(
+                sqlalchemy.select(Invoice.id).where(Invoice.custid == 12)).scalars().all())
+            session.commit()
+            print("mutations bulk update, delete:", TOTALS.check(session))
+
+            session.connection().exec_driver_sql("UPDATE invoices SET amount = 0 WHERE custid = 13")
+            session.commit()
+            print("driver sql, not maintained:", TOTALS.check(session))
+            TOTALS.rebuild(session.connection())
+            session.commit()
+            print("after rebuild:", TOTALS.check(session))
+    finally:
+        TOTALS.remove(engine, Session)
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
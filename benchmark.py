@@ -0,0 +1,431 @@
+########################################################################################################################
+# benchmark of the CRUD scenarios walked through in main.py and main_declarative.py
+#
+#   python benchmark.py --rows 1000 100000 --output results.json
+#   python benchmark.py --compare old.json new.json
+########################################################################################################################
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+import common
+import fixtures
+import main
+import projection
+from fixtures import (
+    customer_rows,
+    student_rows
+)
+from models import Customers
+
+DEFAULT_ROWS = (1000, 10000, 100000)
+DEFAULT_REPEAT = 20
+CHUNK_SIZE = 1000
+
+SCENARIOS = {}
+
+
+def scenario(name, seed=True):
+    """
+    registers a scenario under name
+
+    a scenario receives a Bench and returns (op, count): op is timed count times,
+    seed tells whether the tables are populated with bench.rows rows first
+
+    :param name:
+    :param seed:
+    :return:
+    """
+    def register(f):
+        SCENARIOS[name] = (f, seed)
+        return f
+
+    return register
+
+
+class Bench:
+    """
+    temp sqlite database with the main.py tables and the Customers model
+    """
+
+    def __init__(self, directory, rows, repeat, profile):
+        self.rows = rows
+        self.repeat = repeat
+        self.filename = os.path.join(directory, "bench.db")
+        # the schema comes with the fixtures template, seeded or not
+        fixtures.clone("empty", self.filename)
+        self.engine = common.create_sqlite_engine(self.filename, profile=profile)
+        self.meta = sqlalchemy.MetaData()
+        self.students, self.addresses = main.define_tables(self.meta)
+        self.Session = sessionmaker(bind=self.engine)
+        self.warm_up()
+
+    def seed(self):
+        # a copy of the template seeded with self.rows rows, built on first use
+        self.engine.dispose()
+        fixtures.clone("bench", self.filename, self.rows)
+        self.warm_up()
+
+    def warm_up(self):
+        # the first connection switches the copy to WAL, outside of the timings
+        self.engine.connect().close()
+
+    def close(self):
+        self.engine.dispose()
+
+
+def ids(bench):
+    """
+    endless pseudo random walk over the seeded primary keys
+    """
+    return (1 + (n * 7919) % bench.rows for n in itertools.count())
+
+
+def lastnames(bench):
+    """
+    lastnames of the rows visited by ids()
+    """
+    return (f"lastname{key - 1}" for key in ids(bench))
+
+
+########################################################################################################################
+# CORE, main.py
+########################################################################################################################
+@scenario("core_insert", seed=False)
+def core_insert(bench):
+    chunks = itertools.count(0, CHUNK_SIZE)
+
+    def op():
+        with bench.engine.begin() as conn:
+            conn.execute(bench.students.insert(), list(student_rows(CHUNK_SIZE, next(chunks))))
+
+    return op, max(1, bench.rows // CHUNK_SIZE)
+
+
+def core_select(bench, select, **params):
+    def op():
+        with bench.engine.connect() as conn:
+            for _ in conn.execute(select, params):
+                pass
+
+    return op, bench.repeat
+
+
+@scenario("core_select_all")
+def core_select_all(bench):
+    return core_select(bench, bench.students.select())
+
+
+@scenario("core_select_where")
+def core_select_where(bench):
+    students = bench.students
+    return core_select(bench, students.select().where(students.c.id > bench.rows // 2))
+
+
+@scenario("core_select_text")
+def core_select_text(bench):
+    return core_select(bench, sqlalchemy.sql.text("select * from students"))
+
+
+@scenario("core_select_text_bind")
+def core_select_text_bind(bench):
+    statement = sqlalchemy.sql.text(
+        "select name, students.lastname from students where name = :name"
+    ).bindparams(
+        sqlalchemy.bindparam("name", type_=sqlalchemy.String)
+    )
+    return core_select(bench, statement, name="name1")
+
+
+@scenario("core_select_alias")
+def core_select_alias(bench):
+    alias = bench.students.alias("a")
+    return core_select(bench, sqlalchemy.sql.select(alias).where(alias.c.id > bench.rows // 2))
+
+
+@scenario("core_update")
+def core_update(bench):
+    students = bench.students
+    keys = lastnames(bench)
+
+    def op():
+        with bench.engine.begin() as conn:
+            conn.execute(students.update().where(students.c.lastname == next(keys)).values(lastname="boss"))
+
+    return op, bench.repeat
+
+
+@scenario("core_delete")
+def core_delete(bench):
+    students = bench.students
+    keys = lastnames(bench)
+
+    def op():
+        with bench.engine.begin() as conn:
+            conn.execute(students.delete().where(students.c.lastname == next(keys)))
+
+    return op, bench.repeat
+
+
+########################################################################################################################
+# ORM, main_declarative.py
+########################################################################################################################
+@scenario("orm_add", seed=False)
+def orm_add(bench):
+    rows = customer_rows(bench.rows)
+
+    def op():
+        with bench.Session() as session:
+            session.add(Customers(**next(rows)))
+            session.commit()
+
+    return op, min(bench.rows, bench.repeat * 10)
+
+
+@scenario("orm_add_all", seed=False)
+def orm_add_all(bench):
+    chunks = itertools.count(0, CHUNK_SIZE)
+
+    def op():
+        with bench.Session() as session:
+            session.add_all([Customers(**row) for row in customer_rows(CHUNK_SIZE, next(chunks))])
+            session.commit()
+
+    return op, max(1, bench.rows // CHUNK_SIZE)
+
+
+@scenario("orm_get")
+def orm_get(bench):
+    keys = ids(bench)
+
+    def op():
+        with bench.Session() as session:
+            session.query(Customers).get(next(keys))
+
+    return op, bench.repeat * 10
+
+
+def orm_filter(bench, *criteria):
+    def op():
+        with bench.Session() as session:
+            session.query(Customers).filter(*criteria).all()
+
+    return op, bench.repeat
+
+
+@scenario("orm_filter")
+def orm_filter_disequality(bench):
+    return orm_filter(bench, Customers.id != 2)
+
+
+@scenario("orm_filter_like")
+def orm_filter_like(bench):
+    return orm_filter(bench, Customers.name.like("%e1%"))
+
+
+@scenario("orm_filter_in")
+def orm_filter_in(bench):
+    return orm_filter(bench, Customers.id.in_([1, 3]))
+
+
+@scenario("orm_filter_and")
+def orm_filter_and(bench):
+    return orm_filter(bench, sqlalchemy.and_(Customers.id == 2, Customers.name.like("%name%")))
+
+
+@scenario("orm_filter_or")
+def orm_filter_or(bench):
+    return orm_filter(bench, sqlalchemy.or_(Customers.id == 1, Customers.id == 2))
+
+
+def orm_read(bench, f):
+    def op():
+        with bench.Session() as session:
+            f(session)
+
+    return op, max(1, bench.repeat // 4)
+
+
+@scenario("orm_read_entities")
+def orm_read_entities(bench):
+    return orm_read(bench, lambda session: session.query(Customers).all())
+
+
+@scenario("orm_read_records")
+def orm_read_records(bench):
+    return orm_read(bench, lambda session: list(projection.read(session, Customers)))
+
+
+@scenario("orm_read_columns")
+def orm_read_columns(bench):
+    return orm_read(bench, lambda session: list(projection.read_columns(session, Customers)))
+
+
+@scenario("orm_bulk_update")
+def orm_bulk_update(bench):
+    def op():
+        with bench.Session() as session:
+            session.query(Customers).filter(Customers.id != 2).update(
+                {Customers.name: "Mr." + Customers.name},
+                synchronize_session=False
+            )
+            session.commit()
+
+    return op, max(1, bench.repeat // 4)
+
+
+########################################################################################################################
+# RUNNER
+########################################################################################################################
+def peak_rss_kib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_scenario(name, rows, repeat=DEFAULT_REPEAT, profile=common.PROFILE_BULK_LOAD):
+    """
+    runs one scenario on a fresh temp database
+
+    :param name:
+    :param rows:
+    :param repeat:
+    :param profile:
+    :return: result dict
+    """
+    f, seed = SCENARIOS[name]
+    directory = tempfile.mkdtemp(prefix="bench-")
+    bench = Bench(directory, rows, repeat, profile)
+    try:
+        if seed:
+            bench.seed()
+        op, count = f(bench)
+
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(count):
+            op_start = time.perf_counter()
+            op()
+            latencies.append(time.perf_counter() - op_start)
+        elapsed = time.perf_counter() - start
+    finally:
+        bench.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return dict(
+        scenario=name,
+        rows=rows,
+        ops=count,
+        ops_per_second=count / elapsed,
+        p50=statistics.median(latencies),
+        p99=percentile(latencies, 0.99),
+        peak_rss_kib=peak_rss_kib(),
+    )
+
+
+def run(scenarios, row_counts, repeat=DEFAULT_REPEAT, profile=common.PROFILE_BULK_LOAD):
+    """
+    runs every scenario at every row count, each one in its own process so that
+    peak RSS is not inherited from the previous runs
+
+    :param scenarios:
+    :param row_counts:
+    :param repeat:
+    :param profile:
+    :return: report dict, ready to be dumped as json
+    """
+    results = []
+    for name in scenarios:
+        for rows in row_counts:
+            # templates are built here, once: their construction must not count
+            # in the peak RSS of the first run of the scenario
+            fixtures.template("empty")
+            if SCENARIOS[name][1]:
+                fixtures.template("bench", rows)
+            with multiprocessing.Pool(processes=1, maxtasksperchild=1) as pool:
+                result = pool.apply(run_scenario, (name, rows, repeat, profile))
+            print(format_result(result))
+            results.append(result)
+
+    return dict(
+        meta=dict(
+            timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+            python=platform.python_version(),
+            sqlalchemy=sqlalchemy.__version__,
+            sqlite=sqlite3.sqlite_version,
+            profile=profile,
+            repeat=repeat,
+        ),
+        results=results,
+    )
+
+
+def format_result(result):
+    return (
+        f"{result['scenario']:<22s} rows={result['rows']:<9d} ops={result['ops']:<6d} "
+        f"ops/s={result['ops_per_second']:>11.1f} p50={result['p50'] * 1000:>9.3f}ms "
+        f"p99={result['p99'] * 1000:>9.3f}ms rss={result['peak_rss_kib']}KiB"
+    )
+
+
+def compare(old, new):
+    """
+    prints the ops/s and p99 ratio new/old of the results present in both reports
+
+    :param old:
+    :param new:
+    :return:
+    """
+    previous = {(result["scenario"], result["rows"]): result for result in old["results"]}
+    for result in new["results"]:
+        before = previous.get((result["scenario"], result["rows"]))
+        if before is None:
+            continue
+        print(
+            f"{result['scenario']:<22s} rows={result['rows']:<9d} "
+            f"ops/s x{result['ops_per_second'] / before['ops_per_second']:6.2f} "
+            f"p99 x{result['p99'] / before['p99']:6.2f}"
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark of the main.py and main_declarative.py scenarios")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="default: all")
+    parser.add_argument("--rows", type=int, nargs="+", default=list(DEFAULT_ROWS), help="from 1e3 to 1e7")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--profile", choices=sorted(common.ENGINE_PROFILES), default=common.PROFILE_BULK_LOAD)
+    parser.add_argument("--output", help="json file for the results")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two json results")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+        sys.exit()
+
+    report = run(args.scenario or list(SCENARIOS), args.rows, args.repeat, args.profile)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=4)
@@ -0,0 +1,128 @@
+########################################################################################################################
+# sync (threads) vs asyncio (tasks) throughput of the same primary key lookups, at growing concurrency
+#
+#   python benchmark_async.py --rows 10000 --queries 2000 --concurrency 1 10 100
+########################################################################################################################
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import sqlalchemy
+
+import benchmark
+import common
+from models import Customers
+
+DEFAULT_CONCURRENCY = (1, 10, 100)
+
+
+def lookups(rows, queries):
+    table = Customers.__table__
+    statement = table.select().where(table.c.id == sqlalchemy.bindparam("key"))
+    return statement, [dict(key=1 + (n * 7919) % rows) for n in range(queries)]
+
+
+def result(mode, concurrency, latencies, elapsed):
+    ordered = sorted(latencies)
+    return dict(
+        mode=mode,
+        concurrency=concurrency,
+        queries=len(ordered),
+        queries_per_second=len(ordered) / elapsed,
+        p50=statistics.median(ordered),
+        p99=ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))],
+    )
+
+
+def run_sync(filename, statement, params, concurrency, profile):
+    engine = common.create_sqlite_engine(
+        filename, profile=profile, poolclass=sqlalchemy.pool.QueuePool, pool_size=concurrency, max_overflow=0
+    )
+
+    def query(values):
+        start = time.perf_counter()
+        with engine.connect() as connection:
+            connection.execute(statement, values).all()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(query, params))
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+    return result("sync", concurrency, latencies, elapsed)
+
+
+async def run_async(filename, statement, params, concurrency, profile):
+    engine = common.create_sqlite_async_engine(
+        filename, profile=profile, poolclass=sqlalchemy.pool.AsyncAdaptedQueuePool, pool_size=concurrency, max_overflow=0
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def query(values):
+        async with semaphore:
+            start = time.perf_counter()
+            async with engine.connect() as connection:
+                (await connection.execute(statement, values)).all()
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*[query(values) for values in params])
+    elapsed = time.perf_counter() - start
+    await engine.dispose()
+    return result("async", concurrency, latencies, elapsed)
+
+
+def run(rows, queries, concurrencies, profile=common.PROFILE_READ_HEAVY):
+    """
+    seeds a temp database with rows customers, then runs queries lookups
+    with the sync and the async engine at each concurrency
+
+    :param rows:
+    :param queries:
+    :param concurrencies:
+    :param profile:
+    :return: list of result dicts
+    """
+    directory = tempfile.mkdtemp(prefix="bench-async-")
+    bench = benchmark.Bench(directory, rows, 1, profile)
+    try:
+        bench.seed()
+        bench.close()
+        filename = os.path.join(directory, "bench.db")
+        statement, params = lookups(rows, queries)
+
+        results = []
+        for concurrency in concurrencies:
+            results.append(run_sync(filename, statement, params, concurrency, profile))
+            results.append(asyncio.run(run_async(filename, statement, params, concurrency, profile)))
+            for each in results[-2:]:
+                print(
+                    f"{each['mode']:<6s} concurrency={each['concurrency']:<4d} "
+                    f"q/s={each['queries_per_second']:>9.1f} p50={each['p50'] * 1000:>8.3f}ms "
+                    f"p99={each['p99'] * 1000:>8.3f}ms"
+                )
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="sync vs asyncio primary key lookups")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=list(DEFAULT_CONCURRENCY))
+    parser.add_argument("--profile", choices=sorted(common.ENGINE_PROFILES), default=common.PROFILE_READ_HEAVY)
+    parser.add_argument("--output", help="json file for the results")
+    args = parser.parse_args()
+
+    report = run(args.rows, args.queries, args.concurrency, args.profile)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=4)
@@ -0,0 +1,198 @@
+"""
+fast startup on an existing database: DDL runs only when the schema fingerprint
+stored in the db (in FINGERPRINT_TABLE, one row per MetaData; PRAGMA
+user_version is left to the application) does not match the MetaData, and reflection is read from a
+pickle as long as the db schema is unchanged
+
+    engine = common.create_sqlite_engine("sales.db")
+    ensure_schema(engine, Base.metadata)   # no DDL once the db is up to date
+    meta = reflect(engine)                 # no reflection queries once cached
+"""
+import hashlib
+import logging
+import os
+import pickle
+import time
+
+import sqlalchemy
+# imported explicitly: sqlalchemy.dialects.sqlite is only an attribute once
+# something else has imported it, fingerprint() must not depend on that
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+logger = logging.getLogger(__name__)
+
+CACHE_SUFFIX = ".meta.pickle"
+FINGERPRINT_TABLE = "schema_fingerprint"
+
+
+def fingerprint(metadata, dialect=None):
+    """
+    hash of the CREATE TABLE/INDEX statements of metadata
+
+    :param metadata:
+    :param dialect: default sqlite
+    :return: hex string
+    """
+    dialect = dialect or sqlite.dialect()
+    digest = hashlib.sha256()
+    for table in metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in sorted(table.indexes, key=lambda index: index.name or ""):
+            digest.update(str(CreateIndex(index).compile(dialect=dialect)).encode())
+    return digest.hexdigest()
+
+
+def metadata_key(metadata):
+    """
+    identifier of metadata among the ones sharing a database, a hash of its table names
+
+    :param metadata:
+    :return: hex string
+    """
+    return hashlib.sha256("\n".join(sorted(metadata.tables)).encode()).hexdigest()
+
+
+def _fingerprint_columns(connection):
+    # empty when the table is missing
+    return {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({FINGERPRINT_TABLE})")}
+
+
+def stored_fingerprint(connection, metadata):
+    """
+    :return: the fingerprint saved by ensure_schema for metadata, None if there is none
+    """
+    if "metadata" not in _fingerprint_columns(connection):
+        return None
+    return connection.exec_driver_sql(
+        f"SELECT fingerprint FROM {FINGERPRINT_TABLE} WHERE metadata = ?", (metadata_key(metadata),)
+    ).scalar()
+
+
+def store_fingerprint(connection, metadata, value):
+    columns = _fingerprint_columns(connection)
+    if columns and "metadata" not in columns:
+        # one row per database, before the table was keyed by metadata
+        connection.exec_driver_sql(f"DROP TABLE {FINGERPRINT_TABLE}")
+    connection.exec_driver_sql(
+        f"CREATE TABLE IF NOT EXISTS {FINGERPRINT_TABLE} (metadata TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)"
+    )
+    connection.exec_driver_sql(
+        f"INSERT OR REPLACE INTO {FINGERPRINT_TABLE} (metadata, fingerprint) VALUES (?, ?)",
+        (metadata_key(metadata), value)
+    )
+
+
+def schema_hash(connection):
+    """
+    hash of the schema sqlite actually has, one query on sqlite_master
+
+    :param connection:
+    :return: hex string
+    """
+    rows = connection.exec_driver_sql(
+        "SELECT type, name, coalesce(sql, '') FROM sqlite_master ORDER BY type, name"
+    ).all()
+    return hashlib.sha256(repr(rows).encode()).hexdigest()
+
+
+def ensure_schema(bind, metadata):
+    """
+    metadata.create_all(bind) unless the db already carries the metadata fingerprint,
+    on a mismatch create_all adds the missing tables only, it does not migrate
+
+    :param bind: Engine, or Connection in a transaction
+    :param metadata:
+    :return: True if DDL ran
+    """
+    if isinstance(bind, sqlalchemy.engine.Connection):
+        return _ensure_schema(bind, metadata)
+    with bind.begin() as connection:
+        return _ensure_schema(connection, metadata)
+
+
+def _ensure_schema(connection, metadata):
+    expected = fingerprint(metadata, connection.dialect)
+    if stored_fingerprint(connection, metadata) == expected:
+        logger.debug(f"schema fingerprint {expected[:12]} matches, no DDL")
+        return False
+    metadata.create_all(connection)
+    store_fingerprint(connection, metadata, expected)
+    logger.debug(f"schema created, fingerprint {expected[:12]}")
+    return True
+
+
+def _reflect(connection):
+    metadata = sqlalchemy.MetaData()
+    metadata.reflect(connection, only=lambda name, _: name != FINGERPRINT_TABLE)
+    return metadata
+
+
+def reflect(engine, cache=None):
+    """
+    MetaData reflected from engine, loaded from the cache file as long as the
+    schema hash it was saved with matches the db
+
+    a cache that cannot be loaded, as one pickled by another SQLAlchemy or
+    python version, is replaced; in memory databases are not cached
+
+    :param engine:
+    :param cache: pickle file, default the database file name + CACHE_SUFFIX
+    :return: MetaData
+    """
+    database = engine.url.database
+    if cache is None and database and database != ":memory:":
+        cache = database + CACHE_SUFFIX
+
+    with engine.connect() as connection:
+        if cache is None:
+            return _reflect(connection)
+
+        current = schema_hash(connection)
+        try:
+            with open(cache, "rb") as f:
+                saved, metadata = pickle.load(f)
+            if saved == current:
+                return metadata
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.debug(f"unusable reflection cache {cache}, reflecting again: {e!r}")
+
+        metadata = _reflect(connection)
+
+    with open(cache, "wb") as f:
+        pickle.dump((current, metadata), f, protocol=pickle.HIGHEST_PROTOCOL)
+    return metadata
+
+
+def forget(filename):
+    """
+    removes the reflection cache of filename, resetdb companion
+
+    :param filename:
+    :return:
+    """
+    try:
+        os.remove(filename + CACHE_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import common
+
+    parser = argparse.ArgumentParser(description="cold vs cached startup on a database")
+    parser.add_argument("filename")
+    args = parser.parse_args()
+
+    for attempt in ("cold", "cached"):
+        if attempt == "cold":
+            forget(args.filename)
+        start = time.perf_counter()
+        engine = common.create_sqlite_engine(args.filename)
+        tables = reflect(engine).tables
+        print(f"{attempt:<7s} {(time.perf_counter() - start) * 1000:8.2f}ms tables={sorted(tables)}")
+        engine.dispose()
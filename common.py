@@ -1,10 +1,71 @@
+import abc
+import atexit
+import collections.abc
+import itertools
 import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
 
 import sqlalchemy
+import sqlalchemy.pool
 
 LOGGER_FORMAT = '%(asctime)s | %(levelname)-5s | %(name)-24s | %(funcName)10s() | %(message)s'
 external_logger = None
 
+PROFILE_BULK_LOAD = "bulk-load"
+PROFILE_READ_HEAVY = "read-heavy"
+PROFILE_SAFE = "safe"
+#
+#   connect time PRAGMAs and pool class of each engine profile
+#
+ENGINE_PROFILES = {
+    PROFILE_BULK_LOAD: dict(
+        pragmas=dict(
+            journal_mode="WAL",
+            synchronous="OFF",
+            cache_size=-262144,         # KiB, 256MB
+            mmap_size=0,
+            temp_store="MEMORY",
+            busy_timeout=30000,         # ms
+        ),
+        poolclass=sqlalchemy.pool.SingletonThreadPool,
+    ),
+    PROFILE_READ_HEAVY: dict(
+        pragmas=dict(
+            journal_mode="WAL",
+            synchronous="NORMAL",
+            cache_size=-65536,          # KiB, 64MB
+            mmap_size=268435456,        # bytes, 256MB
+            temp_store="MEMORY",
+            busy_timeout=5000,
+        ),
+        poolclass=sqlalchemy.pool.QueuePool,
+    ),
+    PROFILE_SAFE: dict(
+        pragmas=dict(
+            journal_mode="WAL",
+            synchronous="FULL",
+            cache_size=-8192,           # KiB, 8MB
+            mmap_size=0,
+            temp_store="DEFAULT",
+            busy_timeout=5000,
+        ),
+        poolclass=sqlalchemy.pool.NullPool,
+    ),
+}
+#
+#   profile shared by all the entry scripts, so their numbers are comparable
+#
+DEFAULT_PROFILE = PROFILE_SAFE
+#
+#   sql echo of the scripts: --debug on the command line, or SQL_DEBUG=1
+#
+DEBUG_FLAG = "--debug"
+DEBUG_ENV = "SQL_DEBUG"
+
 
 def setlogger(logger):
     """
@@ -45,11 +106,15 @@ def list_handlers(logger: logging.Logger):
             print("handler: ", h)
 
 
-def fix_loggers():
+def fix_loggers(queued=False, **queue_options):
     """
     sets handler format and propagation for all loggers except root, main and local
 
-    :return:
+    with queued the handlers are then moved behind a queue, see install_queue_logging
+
+    :param queued:
+    :param queue_options: passed to install_queue_logging
+    :return: the QueueLogging if queued, else None
     """
     loggers = [logging.getLogger(name) for name in logging.root.manager.loggerDict if name != __name__ and name != "__main__"]
     for logger in loggers:
@@ -64,33 +129,411 @@ def fix_loggers():
             # logger.propagate = True
             logger.propagate = False
 
+    if queued:
+        return install_queue_logging(**queue_options)
+
+
+QUEUE_DROP = "drop"     # a full queue drops the record
+QUEUE_BLOCK = "block"   # a full queue blocks the caller up to timeout, then drops
+ECHO_LOGGER = "sqlalchemy.engine.Engine"
+ECHO_LOGGERS = "sqlalchemy"     # loggers queued apart from the application ones
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler for a bounded queue, tagging records with the logger whose
+    handlers must write them
+    """
+
+    def __init__(self, records, target, policy=QUEUE_DROP, timeout=0.1):
+        super().__init__(records)
+        self.target = target
+        self.policy = policy
+        self.timeout = timeout
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.queue_target = self.target
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.policy == QUEUE_BLOCK:
+                self.queue.put(record, timeout=self.timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RoutingQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener writing each record with the original handlers of its logger
+    """
+
+    def __init__(self, records, routes):
+        super().__init__(records)
+        self.routes = routes
+
+    def enqueue_sentinel(self):
+        # waits for room instead of failing on a full queue
+        self.queue.put(self._sentinel)
+
+    def handle(self, record):
+        for handler in self.routes.get(record.queue_target, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    token bucket letting through rate records per second, with bursts up to burst
+    """
+
+    def __init__(self, rate, burst=None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.suppressed = 0
+
+    def filter(self, record):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return False
+        self.tokens -= 1
+        return True
 
-def log_rows(rows):
+
+class QueueLogging:
+    """
+    handle on an installed queue logging setup
+    """
+
+    def __init__(self, listeners, routes, handlers, rate_filter):
+        self.listeners = listeners
+        self.routes = routes
+        self.handlers = handlers
+        self.rate_filter = rate_filter
+        self.stopped = False
+
+    @property
+    def dropped(self):
+        return sum(handler.dropped for handler in self.handlers.values())
+
+    @property
+    def dropped_echo(self):
+        return sum(handler.dropped for name, handler in self.handlers.items() if is_echo_logger(name))
+
+    @property
+    def suppressed(self):
+        return self.rate_filter.suppressed if self.rate_filter is not None else 0
+
+    def stop(self):
+        """
+        writes the queued records and puts the original handlers back
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        for listener in self.listeners:
+            listener.stop()
+        for name, handler in self.handlers.items():
+            logger = logging.getLogger(name) if name else logging.root
+            logger.removeHandler(handler)
+            for original in self.routes[name]:
+                logger.addHandler(original)
+        if self.rate_filter is not None:
+            logging.getLogger(ECHO_LOGGER).removeFilter(self.rate_filter)
+
+
+def is_echo_logger(name):
+    return name == ECHO_LOGGERS or name.startswith(ECHO_LOGGERS + ".")
+
+
+def install_queue_logging(maxsize=10000, policy=QUEUE_DROP, timeout=0.1, echo_rate=None, echo_maxsize=None):
+    """
+    moves the handlers of root and of every logger that has its own handlers
+    (like the sql echo one) behind bounded queues, written by background threads
+
+    the calling thread only formats the message and enqueues it; with QUEUE_DROP
+    a full queue drops the record, with QUEUE_BLOCK it waits up to timeout first;
+    echo_rate limits the engine echo logger to echo_rate records per second
+
+    the sqlalchemy loggers have a queue of their own, so that a flood of sql
+    echo never drops application records; each queue has its writer thread,
+    records of the two may be written out of order
+
+    :param maxsize: of the application queue
+    :param policy: QUEUE_DROP or QUEUE_BLOCK
+    :param timeout:
+    :param echo_rate:
+    :param echo_maxsize: of the sqlalchemy queue, default maxsize
+    :return: QueueLogging, stopped at exit
+    """
+    if policy not in (QUEUE_DROP, QUEUE_BLOCK):
+        raise ValueError(f"unknown queue policy: {policy!r}")
+
+    records = queue.Queue(maxsize)
+    echo_records = queue.Queue(echo_maxsize if echo_maxsize is not None else maxsize)
+    loggers = [logging.root] + [
+        logging.getLogger(name) for name, logger in list(logging.root.manager.loggerDict.items())
+        if isinstance(logger, logging.Logger) and logger.handlers
+    ]
+
+    routes = {}
+    handlers = {}
+    for logger in loggers:
+        name = "" if logger is logging.root else logger.name
+        routes[name] = list(logger.handlers)
+        handlers[name] = BoundedQueueHandler(echo_records if is_echo_logger(name) else records, name, policy, timeout)
+        logger.handlers = [handlers[name]]
+
+    rate_filter = None
+    if echo_rate is not None:
+        rate_filter = RateLimitFilter(echo_rate)
+        logging.getLogger(ECHO_LOGGER).addFilter(rate_filter)
+
+    listeners = [RoutingQueueListener(records, routes), RoutingQueueListener(echo_records, routes)]
+    for listener in listeners:
+        listener.start()
+    queue_logging = QueueLogging(listeners, routes, handlers, rate_filter)
+    atexit.register(queue_logging.stop)
+    return queue_logging
+
+
+ROW_FORMAT = "{row.id:2d}, {row.name:<6.6s}, {row.address:<15.15s}, {row.email}"
+ROW_COLUMNS = ("id", "name", "address", "email")
+
+
+def log_rows(rows, batch_size=1, columns=None):
     """
     logs rows of current result
 
-    :param rows:
+    nothing is executed or formatted when INFO is disabled, Query and Result
+    objects are consumed lazily batch_size rows at a time, each batch is
+    emitted as one log record; columns projects a Query on those attributes
+    so that it does not load full entities just to log them
+
+    :param rows: row, list, iterator (as projection.read), Query or Result
+    :param batch_size: rows per log record
+    :param columns: attribute names, ROW_COLUMNS to log the default fields only
     :return:
     """
-    if not isinstance(rows, list) and not isinstance(rows, sqlalchemy.orm.query.Query):
+    if not external_logger.isEnabledFor(logging.INFO):
+        return
+
+    if isinstance(rows, sqlalchemy.orm.query.Query):
+        if columns:
+            entity = rows.column_descriptions[0]["entity"]
+            rows = rows.with_entities(*[getattr(entity, column) for column in columns])
+        rows = rows.yield_per(batch_size) if batch_size > 1 else rows
+    elif not isinstance(rows, (list, sqlalchemy.engine.Result, collections.abc.Iterator)):
         rows = [rows]
 
-    for row in rows:
-        external_logger.info(f"{row.id:2d}, {row.name:<6.6s}, {row.address:<15.15s}, {row.email}")
+    if batch_size == 1:
+        for row in rows:
+            external_logger.info(ROW_FORMAT.format(row=row))
+        return
+
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        external_logger.info("\n".join(ROW_FORMAT.format(row=row) for row in batch))
 
 
-def resetdb(filename):
+def engine_profile(profile):
+    try:
+        return ENGINE_PROFILES[profile]
+    except KeyError:
+        raise ValueError(f"unknown engine profile: {profile!r}") from None
+
+
+def set_pragmas_on_connect(engine, pragmas):
+    """
+    applies pragmas to every new pooled connection of engine
+
+    :param engine: a sync Engine, for an AsyncEngine pass its sync_engine
+    :param pragmas:
+    :return:
+    """
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+class CursorTimer(abc.ABC):
+    """
+    times the cursor executions of one engine, or of all of them when installed
+    on the Engine class, handing each one to timed()
+
+    the start times are a stack in conn.info, one per timer, so that statements
+    run from inside another execution and failed executions keep them paired
+    """
+
+    def install(self, engine=sqlalchemy.engine.Engine):
+        sqlalchemy.event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        sqlalchemy.event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+        sqlalchemy.event.listen(engine, "handle_error", self.handle_error)
+        return self
+
+    def remove(self, engine=sqlalchemy.engine.Engine):
+        sqlalchemy.event.remove(engine, "before_cursor_execute", self.before_cursor_execute)
+        sqlalchemy.event.remove(engine, "after_cursor_execute", self.after_cursor_execute)
+        sqlalchemy.event.remove(engine, "handle_error", self.handle_error)
+
+    @property
+    def info_key(self):
+        return f"cursor_timer_{id(self)}"
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault(self.info_key, []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get(self.info_key)
+        if not starts:
+            # installed while the statement was running
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        self.timed(conn, cursor, statement, parameters, context, executemany, elapsed)
+
+    def handle_error(self, exception_context):
+        # a failed execution has no after_cursor_execute
+        connection = exception_context.connection
+        starts = connection.info.get(self.info_key) if connection is not None else None
+        if starts and exception_context.cursor is not None:
+            starts.pop()
+
+    @abc.abstractmethod
+    def timed(self, conn, cursor, statement, parameters, context, executemany, elapsed):
+        """
+        called after each execution, with the after_cursor_execute arguments
+
+        :param elapsed: seconds
+        """
+
+
+SQLALCHEMY_DIR = os.path.dirname(sqlalchemy.__file__) + os.sep
+
+
+def user_stacklevel(*filenames):
+    """
+    warnings.warn stacklevel, for the caller of user_stacklevel, of the first
+    frame outside filenames and sqlalchemy: the user code that triggered the warning
+
+    :param filenames: modules to skip, usually the __file__ of the caller
+    :return:
+    """
+    level = 1
+    frame = sys._getframe(1)
+    while frame is not None and (
+            frame.f_code.co_filename in filenames or frame.f_code.co_filename.startswith(SQLALCHEMY_DIR)
+    ):
+        frame = frame.f_back
+        level += 1
+    return level
+
+
+def debug_requested(argv=None):
     """
-    delete db on start
+    :param argv: default sys.argv
+    :return: True with DEBUG_FLAG in argv or DEBUG_ENV set to anything but 0
+    """
+    argv = sys.argv if argv is None else argv
+    return DEBUG_FLAG in argv[1:] or os.environ.get(DEBUG_ENV, "0") not in ("", "0")
+
+
+def create_sqlite_engine(filename, profile=DEFAULT_PROFILE, debug=None, **kwargs):
+    """
+    creates a sqlite engine configured by one of ENGINE_PROFILES
+
+    the profile PRAGMAs are applied to every new pooled connection,
+    sql echo is enabled only in debug
 
     :param filename:
+    :param profile:
+    :param debug: default debug_requested()
+    :param kwargs: passed to sqlalchemy.create_engine
+    :return:
+    """
+    settings = engine_profile(profile)
+    if debug is None:
+        debug = debug_requested()
+    kwargs.setdefault("poolclass", settings["poolclass"])
+    kwargs["connect_args"] = dict(kwargs.get("connect_args", {}))
+    if issubclass(kwargs["poolclass"], sqlalchemy.pool.QueuePool):
+        # pooled connections are handed to whichever thread checks them out
+        kwargs["connect_args"].setdefault("check_same_thread", False)
+    engine = sqlalchemy.create_engine(f"sqlite:///{filename}", echo=debug, **kwargs)
+    set_pragmas_on_connect(engine, settings["pragmas"])
+    return engine
+
+
+#
+#   asyncio compatible pool matching each profile pool class
+#
+ASYNC_POOLS = {
+    sqlalchemy.pool.SingletonThreadPool: sqlalchemy.pool.AsyncAdaptedQueuePool,
+    sqlalchemy.pool.QueuePool: sqlalchemy.pool.AsyncAdaptedQueuePool,
+    sqlalchemy.pool.NullPool: sqlalchemy.pool.NullPool,
+}
+
+
+def create_sqlite_async_engine(filename, profile=DEFAULT_PROFILE, debug=None, **kwargs):
+    """
+    create_sqlite_engine for asyncio, on the aiosqlite driver
+
+    aiosqlite runs each connection in a thread of its own, check_same_thread
+    is not needed
+
+    :param filename:
+    :param profile:
+    :param debug: default debug_requested()
+    :param kwargs: passed to sqlalchemy.ext.asyncio.create_async_engine
+    :return: AsyncEngine
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    settings = engine_profile(profile)
+    if debug is None:
+        debug = debug_requested()
+    kwargs.setdefault("poolclass", ASYNC_POOLS[settings["poolclass"]])
+    engine = create_async_engine(f"sqlite+aiosqlite:///{filename}", echo=debug, **kwargs)
+    set_pragmas_on_connect(engine.sync_engine, settings["pragmas"])
+    return engine
+
+
+def resetdb(filename, seed=None, size=None):
+    """
+    delete db on start, with its WAL files
+
+    with seed, the db is then a copy of that fixtures seed set template,
+    schema and rows included
+
+    :param filename:
+    :param seed: fixtures.SEED_SETS name
+    :param size: rows of the seed set, default its own
     :return:
     """
-    import os
     #
     #   start from scratch
     #
-    try:
-        os.remove(filename)
-    except FileNotFoundError:
-        pass
+    for path in (filename, f"{filename}-wal", f"{filename}-shm"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    if seed is not None:
+        import fixtures
+        fixtures.clone(seed, filename, size)
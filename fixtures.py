@@ -0,0 +1,263 @@
+"""
+seeded template databases, built once and cloned for every run
+
+    fixtures.clone("sales", "sales.db", size=1000)      # file copy, a reflink where supported
+    fixtures.clone("sales", "sales.db", method=fixtures.CLONE_BACKUP)
+    engine = fixtures.memory_engine("tutorial")         # :memory: copy of the template
+
+the templates live in FIXTURES_DIR, named after the seed set, its size and
+the schema fingerprint, so a schema change builds new ones
+"""
+import fcntl
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import sqlalchemy
+
+import bootstrap
+import common
+import main
+from models import Base
+
+FIXTURES_DIR = os.environ.get("FIXTURES_DIR", os.path.join(tempfile.gettempdir(), "sqlalchemy-tutorials-fixtures"))
+#
+#   bump when a seed set changes its rows
+#
+FIXTURES_VERSION = 2
+
+CLONE_COPY = "copy"         # file copy, copy on write reflink when the filesystem has it
+CLONE_BACKUP = "backup"     # sqlite online backup API, page by page
+FICLONE = 0x40049409        # linux ioctl, btrfs/xfs reflink
+
+SEED_SETS = {}
+
+
+def seed_set(name, size):
+    """
+    registers a seed set under name
+
+    a seed set receives an engine on the template being built, its schema
+    created, the college tables (students, addresses) and the number of
+    rows, size when not given; large seed sets stream their rows with
+    main.bulk_insert, a transaction per chunk
+
+    :param name:
+    :param size: default number of rows
+    :return:
+    """
+    def register(f):
+        SEED_SETS[name] = (f, size)
+        return f
+
+    return register
+
+
+def student_rows(count, start=0):
+    return (dict(name=f"name{n}", lastname=f"lastname{n}") for n in range(start, start + count))
+
+
+def customer_rows(count, start=0):
+    return (
+        dict(name=f"name{n}", address=f"street {n}", email=f"name{n}@mail.com")
+        for n in range(start, start + count)
+    )
+
+
+def invoice_rows(customers, per_customer=3):
+    return (
+        dict(custid=custid, invno=custid * 10 + n, amount=custid * 1000 + n * 100)
+        for custid in range(1, customers + 1)
+        for n in range(per_customer)
+    )
+
+
+########################################################################################################################
+# SEED SETS
+########################################################################################################################
+@seed_set("empty", 0)
+def empty(engine, college, size):
+    pass
+
+
+@seed_set("tutorial", 1)
+def tutorial(engine, college, size):
+    # the rows of the main_declarative.py and main_relations.py walkthroughs, size times
+    students, addresses = college
+    with engine.begin() as connection:
+        for _ in range(size):
+            connection.execute(students.insert(), [
+                dict(name='fab', lastname='cat'),
+                dict(name='one', lastname='guy'),
+                dict(name='the', lastname='mandalorian'),
+                dict(name='darth', lastname='vader'),
+            ])
+            connection.execute(Base.metadata.tables["customers"].insert(), [
+                dict(name="Fab", address="meow street 9", email="fab@meow.com"),
+                dict(name="robb", address="here", email="email@gmail.com"),
+                dict(name="frank", address="castiglione", email="punisher@gmail.com"),
+            ])
+        connection.execute(addresses.insert(), [
+            dict(st_id=st_id, postal_add=f"street {st_id}", email_add=f"student{st_id}@college.edu")
+            for st_id in range(1, 4 * size + 1)
+        ])
+        connection.execute(Base.metadata.tables["invoices"].insert(), list(invoice_rows(3 * size)))
+
+
+@seed_set("bench", 10000)
+def bench(engine, college, size):
+    # benchmark.Bench tables
+    students, _ = college
+    main.bulk_insert(engine, students, student_rows(size))
+    main.bulk_insert(engine, Base.metadata.tables["customers"], customer_rows(size))
+
+
+@seed_set("sales", 1000)
+def sales(engine, college, size):
+    # customers with 3 invoices each
+    main.bulk_insert(engine, Base.metadata.tables["customers"], customer_rows(size))
+    main.bulk_insert(engine, Base.metadata.tables["invoices"], invoice_rows(size))
+
+
+########################################################################################################################
+# TEMPLATES
+########################################################################################################################
+def template(name, size=None):
+    """
+    path of the template database of the seed set name, built if missing
+
+    :param name:
+    :param size: default the seed set size
+    :return:
+    """
+    f, default_size = SEED_SETS[name]
+    size = default_size if size is None else size
+
+    college = sqlalchemy.MetaData()
+    tables = main.define_tables(college)
+    version = hashlib.sha256((bootstrap.fingerprint(college) + bootstrap.fingerprint(Base.metadata)).encode())
+    path = os.path.join(FIXTURES_DIR, f"{name}-{size}-v{FIXTURES_VERSION}-{version.hexdigest()[:16]}.db")
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    # built aside and renamed, so a concurrent run never sees half a template
+    building = f"{path}.{os.getpid()}"
+    common.resetdb(building)
+    engine = common.create_sqlite_engine(building, profile=common.PROFILE_BULK_LOAD)
+    try:
+        with engine.begin() as connection:
+            # fingerprints stored, so that the clones skip the DDL
+            bootstrap.ensure_schema(connection, college)
+            bootstrap.ensure_schema(connection, Base.metadata)
+        f(engine, tables, size)
+        with engine.connect() as connection:
+            # a single file, without WAL, is what gets copied
+            connection.exec_driver_sql("PRAGMA journal_mode=DELETE")
+            connection.exec_driver_sql("VACUUM")
+        engine.dispose()
+        os.replace(building, path)
+    finally:
+        engine.dispose()
+        # what is left of a failed build, nothing after the rename
+        common.resetdb(building)
+    return path
+
+
+def copy_file(source, target):
+    """
+    reflink of source when the filesystem supports it, a plain copy otherwise
+
+    :param source:
+    :param target:
+    :return:
+    """
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def clone(name, filename, size=None, method=CLONE_COPY):
+    """
+    replaces filename, and its WAL files, with a copy of the seed set template
+
+    :param name: seed set
+    :param filename:
+    :param size: default the seed set size
+    :param method: CLONE_COPY or CLONE_BACKUP
+    :return: filename
+    """
+    source = template(name, size)
+    common.resetdb(filename)
+    if method == CLONE_COPY:
+        copy_file(source, filename)
+    elif method == CLONE_BACKUP:
+        src, dst = sqlite3.connect(source), sqlite3.connect(filename)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+    else:
+        raise ValueError(f"unknown clone method: {method!r}")
+    return filename
+
+
+def memory_engine(name, size=None, debug=False):
+    """
+    engine on a private :memory: database loaded from the seed set template,
+    the backup API copies it in when the only connection is created
+
+    :param name: seed set
+    :param size: default the seed set size
+    :param debug: log sql statements
+    :return:
+    """
+    source = template(name, size)
+
+    def creator():
+        connection = sqlite3.connect(":memory:", check_same_thread=False)
+        src = sqlite3.connect(source)
+        try:
+            src.backup(connection)
+        finally:
+            src.close()
+        return connection
+
+    return sqlalchemy.create_engine(
+        "sqlite://", creator=creator, poolclass=sqlalchemy.pool.StaticPool, echo=debug
+    )
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="template clone timings, against building the seed set")
+    parser.add_argument("--seed", choices=sorted(SEED_SETS), default="bench")
+    parser.add_argument("--size", type=int)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    template(args.seed, args.size)
+    print(f"template  {(time.perf_counter() - start) * 1000:9.2f}ms (built unless already there)")
+
+    directory = tempfile.mkdtemp(prefix="fixtures-")
+    try:
+        for method in (CLONE_COPY, CLONE_BACKUP):
+            start = time.perf_counter()
+            clone(args.seed, os.path.join(directory, "clone.db"), args.size, method)
+            print(f"{method:<9s} {(time.perf_counter() - start) * 1000:9.2f}ms")
+        start = time.perf_counter()
+        engine = memory_engine(args.seed, args.size)
+        with engine.connect() as connection:
+            count = connection.exec_driver_sql("SELECT count(*) FROM customers").scalar()
+        print(f"{'memory':<9s} {(time.perf_counter() - start) * 1000:9.2f}ms customers={count}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
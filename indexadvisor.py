@@ -0,0 +1,336 @@
+"""
+index advisor: records the filtered and joined columns of the statements an
+engine runs, finds the full table scans in their EXPLAIN QUERY PLAN and
+proposes the indexes that remove them, applying them on request with
+before/after timings
+
+    advisor = IndexAdvisor().install(engine)
+    ... run the workload ...
+    for proposal in advisor.advise(engine):
+        print(proposal.ddl, proposal.reason)
+    for timing in advisor.apply(engine):
+        print(timing)
+"""
+import collections
+import re
+import time
+
+import sqlalchemy
+from sqlalchemy.sql import operators, visitors
+
+import common
+
+EQUALITY = "equality"   # =, IN, IS: any of them can lead an index
+RANGE = "range"         # <, >, BETWEEN: one of them, after the equalities
+JOIN = "join"           # column = column of another table
+
+OPERATORS = {
+    operators.eq: EQUALITY,
+    operators.in_op: EQUALITY,
+    operators.is_: EQUALITY,
+    operators.lt: RANGE,
+    operators.le: RANGE,
+    operators.gt: RANGE,
+    operators.ge: RANGE,
+    operators.between_op: RANGE,
+}
+# LIKE is not indexed: sqlite needs case_sensitive_like or NOCASE columns, and no leading %
+
+SCAN = re.compile(r"^SCAN (?:TABLE )?(?!TABLE )(\w+)\b(?! USING (?:COVERING )?INDEX)")
+AUTOMATIC_INDEX = re.compile(r"^SEARCH (?:TABLE )?(\w+) USING AUTOMATIC")
+
+IndexProposal = collections.namedtuple("IndexProposal", "table columns reason statements ddl")
+Timing = collections.namedtuple("Timing", "statement before after speedup")
+
+
+class StatementStats:
+    def __init__(self, statement, parameters):
+        self.statement = statement
+        self.parameters = parameters    # of the first execution, to EXPLAIN and time it
+        self.count = 0
+        self.elapsed = 0.0
+        self.columns = collections.defaultdict(set)     # table: {(column, EQUALITY|RANGE|JOIN)}
+        self.read = set()                               # (table, column) referenced anywhere
+
+
+def predicates(statement):
+    """
+    (table, column, kind) of the comparisons in statement, subqueries and join conditions included
+
+    :param statement:
+    :return: set
+    """
+    found = set()
+    for element in visitors.iterate(statement):
+        if not isinstance(element, sqlalchemy.sql.expression.BinaryExpression):
+            continue
+        kind = OPERATORS.get(element.operator)
+        if kind is None:
+            continue
+        left, right = element.left, element.right
+        left_column = isinstance(left, sqlalchemy.Column) and isinstance(left.table, sqlalchemy.Table)
+        right_column = isinstance(right, sqlalchemy.Column) and isinstance(right.table, sqlalchemy.Table)
+        if left_column and right_column:
+            if left.table is not right.table and kind == EQUALITY:
+                found.add((left.table.name, left.name, JOIN))
+                found.add((right.table.name, right.name, JOIN))
+        elif left_column:
+            found.add((left.table.name, left.name, kind))
+        elif right_column:
+            found.add((right.table.name, right.name, kind))
+    return found
+
+
+class IndexAdvisor(common.CursorTimer):
+    """
+    single column and composite index proposals for the recorded statements
+
+    a proposal leads with the equality columns of a statement, then one range column,
+    covering=True appends the other columns it reads from the table
+    """
+
+    def __init__(self, max_statements=1000):
+        self.max_statements = max_statements
+        self.statements = collections.OrderedDict()  # sql: StatementStats
+        self.proposals = []
+
+    def timed(self, conn, cursor, statement, parameters, context, executemany, elapsed):
+        compiled = getattr(context, "compiled", None)
+        if executemany or compiled is None or context.isinsert or context.isddl:
+            return
+
+        stats = self.statements.get(statement)
+        if stats is None:
+            if len(self.statements) >= self.max_statements:
+                return
+            stats = self.statements[statement] = StatementStats(statement, parameters)
+            for table, column, kind in predicates(compiled.statement):
+                stats.columns[table].add((column, kind))
+            stats.read.update(
+                (column.table.name, column.name)
+                for column in visitors.iterate(compiled.statement)
+                if isinstance(column, sqlalchemy.Column) and isinstance(column.table, sqlalchemy.Table)
+            )
+        stats.count += 1
+        stats.elapsed += elapsed
+
+    #
+    #   analysis
+    #
+    @staticmethod
+    def explain(connection, statement, parameters=()):
+        """
+        :return: the detail column of EXPLAIN QUERY PLAN
+        """
+        return [row[3] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+
+    @staticmethod
+    def scanned(plan):
+        """
+        tables read in full, or through an index sqlite builds at every execution
+
+        :param plan: explain() output
+        :return: set of table names
+        """
+        tables = set()
+        for detail in plan:
+            match = SCAN.match(detail) or AUTOMATIC_INDEX.match(detail)
+            if match:
+                tables.add(match.group(1))
+        return tables
+
+    @staticmethod
+    def indexed(inspector, table):
+        """
+        column tuples already leading an index of table, the integer primary key included
+        """
+        leading = {tuple(index["column_names"]) for index in inspector.get_indexes(table)}
+        primary_key = inspector.get_pk_constraint(table)["constrained_columns"]
+        if primary_key:
+            leading.add(tuple(primary_key))
+        return leading
+
+    @staticmethod
+    def unindexed_foreign_keys(engine):
+        """
+        foreign key columns with no index starting with them: every delete of
+        the parent and every join from it scans the child table
+
+        :param engine:
+        :return: list of (table, columns)
+        """
+        inspector = sqlalchemy.inspect(engine)
+        missing = []
+        for table in inspector.get_table_names():
+            leading = IndexAdvisor.indexed(inspector, table)
+            for foreign_key in inspector.get_foreign_keys(table):
+                columns = tuple(foreign_key["constrained_columns"])
+                if not any(index[:len(columns)] == columns for index in leading):
+                    missing.append((table, columns))
+        return missing
+
+    def advise(self, engine, covering=False):
+        """
+        proposals for the recorded statements whose plans scan a table on
+        which they filter or join, plus the unindexed foreign keys
+
+        :param engine:
+        :param covering: append the other read columns, so the table itself is not read
+        :return: list of IndexProposal, also kept in self.proposals
+        """
+        inspector = sqlalchemy.inspect(engine)
+        preparer = engine.dialect.identifier_preparer
+        proposals = collections.OrderedDict()   # (table, columns): (reason, statements)
+
+        def propose(table, columns, reason, statement=None):
+            leading = self.indexed(inspector, table)
+            if any(index[:len(columns)] == columns for index in leading):
+                return
+            reasons, statements = proposals.setdefault((table, columns), ([], []))
+            if reason not in reasons:
+                reasons.append(reason)
+            if statement is not None:
+                statements.append(statement)
+
+        for table, columns in self.unindexed_foreign_keys(engine):
+            propose(table, columns, "unindexed foreign key")
+
+        with engine.connect() as connection:
+            for stats in self.statements.values():
+                try:
+                    plan = self.explain(connection, stats.statement, stats.parameters)
+                except sqlalchemy.exc.DBAPIError:
+                    continue
+                for table in self.scanned(plan) & set(stats.columns):
+                    kinds = collections.defaultdict(list)
+                    for column, kind in sorted(stats.columns[table]):
+                        kinds[kind].append(column)
+                    columns = tuple(kinds[EQUALITY]) + tuple(kinds[RANGE][:1])
+                    reason = "full scan filtered on " + ", ".join(columns) if columns else None
+                    if not columns and kinds[JOIN]:
+                        columns = tuple(kinds[JOIN][:1])
+                        reason = f"full scan joined on {columns[0]}"
+                    if not columns:
+                        continue
+                    if covering:
+                        columns += tuple(sorted(
+                            column for name, column in stats.read if name == table and column not in columns
+                        ))
+                    propose(table, columns, reason, stats.statement)
+
+        # an index on (a, b) serves the lookups on a too: fold the shorter proposal into the longer one
+        for table, columns in list(proposals):
+            longer = [
+                other for other in proposals
+                if other[0] == table and len(other[1]) > len(columns) and other[1][:len(columns)] == columns
+            ]
+            if not longer:
+                continue
+            reasons, statements = proposals.pop((table, columns))
+            longer_reasons, longer_statements = proposals[max(longer, key=lambda other: len(other[1]))]
+            longer_reasons.extend(reason for reason in reasons if reason not in longer_reasons)
+            longer_statements.extend(statement for statement in statements if statement not in longer_statements)
+
+        self.proposals = []
+        for (table, columns), (reasons, statements) in proposals.items():
+            name = f"ix_{table}_{'_'.join(columns)}"
+            ddl = (
+                f"CREATE INDEX IF NOT EXISTS {preparer.quote(name)} ON {preparer.quote(table)} "
+                f"({', '.join(preparer.quote(column) for column in columns)})"
+            )
+            self.proposals.append(IndexProposal(table, columns, "; ".join(reasons), statements, ddl))
+        return self.proposals
+
+    #
+    #   apply
+    #
+    def time_statement(self, connection, stats, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            connection.exec_driver_sql(stats.statement, stats.parameters).fetchall()
+        return (time.perf_counter() - start) / repeat
+
+    def apply(self, engine, proposals=None, repeat=5):
+        """
+        creates the proposed indexes, ANALYZE included, timing the statements
+        they were proposed for before and after
+
+        :param engine:
+        :param proposals: default self.proposals, see advise()
+        :param repeat: runs of each statement per timing
+        :return: list of Timing, seconds per execution
+        """
+        proposals = self.proposals if proposals is None else proposals
+        affected = [
+            self.statements[statement]
+            for statement in dict.fromkeys(s for proposal in proposals for s in proposal.statements)
+            if self.statements[statement].statement.lstrip()[:6].upper() == "SELECT"
+        ]
+
+        with engine.connect() as connection:
+            before = [self.time_statement(connection, stats, repeat) for stats in affected]
+
+        with engine.begin() as connection:
+            for proposal in proposals:
+                connection.exec_driver_sql(proposal.ddl)
+            connection.exec_driver_sql("ANALYZE")
+
+        with engine.connect() as connection:
+            after = [self.time_statement(connection, stats, repeat) for stats in affected]
+
+        return [
+            Timing(stats.statement, old, new, old / new if new else float("inf"))
+            for stats, old, new in zip(affected, before, after)
+        ]
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import shutil
+    import tempfile
+
+    from sqlalchemy.orm import sessionmaker
+
+    import fixtures
+    import main
+    from models import Customers, Invoice
+
+    parser = argparse.ArgumentParser(description="index proposals for the tutorial queries, with before/after timings")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--covering", action="store_true")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="advisor-")
+    filename = fixtures.clone("sales", os.path.join(directory, "sales.db"), args.rows)
+    engine = common.create_sqlite_engine(filename, profile=common.PROFILE_READ_HEAVY)
+    advisor = IndexAdvisor().install(engine)
+    students, addresses = main.define_tables(sqlalchemy.MetaData())
+    try:
+        with engine.connect() as connection:
+            connection.execute(students.select().where(students.c.lastname == "boss")).all()
+            connection.execute(
+                sqlalchemy.select(students.c.name, addresses.c.email_add)
+                .join_from(students, addresses, students.c.id == addresses.c.st_id)
+                .where(students.c.name == "bob")
+            ).all()
+        with sessionmaker(bind=engine)() as session:
+            session.query(Customers).filter(Customers.name == f"name{args.rows // 2}").all()
+            session.query(Customers).filter(Customers.name.like("%e1%")).all()
+            session.query(Customers).filter(Customers.id.in_([1, 3])).all()
+            session.query(Invoice).filter(Invoice.custid == args.rows // 3).all()
+            session.query(Invoice.invno, Invoice.amount).filter(
+                Invoice.custid == args.rows // 4, Invoice.amount > 1000
+            ).all()
+
+        advisor.remove(engine)
+        for proposal in advisor.advise(engine, covering=args.covering):
+            print(f"{proposal.ddl}\n    {proposal.reason}, {len(proposal.statements)} statement(s)")
+        for timing in advisor.apply(engine):
+            print(
+                f"{timing.before * 1000:9.3f}ms -> {timing.after * 1000:9.3f}ms x{timing.speedup:7.1f} | "
+                + " ".join(timing.statement.split())
+            )
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,108 @@
+"""
+relationship loading strategies selectable per query, and N+1 lazy load detection
+"""
+import warnings
+import weakref
+
+import sqlalchemy
+from sqlalchemy.orm import (
+    joinedload,
+    lazyload,
+    raiseload,
+    selectinload,
+    subqueryload
+)
+
+import common
+
+LOADERS = {
+    "select": lazyload,         # default: one SELECT per parent, on first access
+    "selectin": selectinload,   # one extra SELECT ... WHERE fk IN (...) per query
+    "joined": joinedload,       # LEFT OUTER JOIN in the same query
+    "subquery": subqueryload,   # one extra SELECT joined to the original query
+    "raise": raiseload,         # accessing a not loaded relationship raises
+}
+
+
+def load(relationship, strategy):
+    """
+    returns the loader option for relationship, to be passed to query.options()
+
+        session.query(Customers).options(load(Customers.invoices, "selectin"))
+
+    :param relationship: relationship attribute, like Customers.invoices
+    :param strategy: one of LOADERS
+    :return:
+    """
+    try:
+        loader = LOADERS[strategy]
+    except KeyError:
+        raise ValueError(f"unknown loading strategy: {strategy!r}") from None
+    return loader(relationship)
+
+
+class NPlusOneWarning(UserWarning):
+    pass
+
+
+class NPlusOneError(sqlalchemy.exc.InvalidRequestError):
+    pass
+
+
+class NPlusOneDetector:
+    """
+    counts the lazy loads issued by each session between commits/rollbacks
+
+    when a session crosses threshold lazy loads within one unit of work
+    it warns, or raises NPlusOneError if raise_error, once per unit of work
+    """
+
+    def __init__(self, threshold=10, raise_error=False):
+        self.threshold = threshold
+        self.raise_error = raise_error
+        self.counts = weakref.WeakKeyDictionary()
+
+    def install(self, target):
+        """
+        listens on target, a Session, a sessionmaker or the Session class
+
+        :param target:
+        :return: self
+        """
+        sqlalchemy.event.listen(target, "do_orm_execute", self.do_orm_execute)
+        sqlalchemy.event.listen(target, "after_commit", self.reset)
+        sqlalchemy.event.listen(target, "after_rollback", self.reset)
+        return self
+
+    def uninstall(self, target):
+        sqlalchemy.event.remove(target, "do_orm_execute", self.do_orm_execute)
+        sqlalchemy.event.remove(target, "after_commit", self.reset)
+        sqlalchemy.event.remove(target, "after_rollback", self.reset)
+
+    def reset(self, session):
+        self.counts.pop(session, None)
+
+    def count(self, session):
+        """
+        lazy loads of session in the current unit of work
+        """
+        return self.counts.get(session, 0)
+
+    def do_orm_execute(self, orm_execute_state):
+        parent = orm_execute_state.lazy_loaded_from
+        if parent is None:
+            return
+
+        session = orm_execute_state.session
+        count = self.counts.get(session, 0) + 1
+        self.counts[session] = count
+        if count != self.threshold:
+            return
+
+        message = (
+            f"{count} lazy loads in one unit of work, last one from {parent.class_.__name__}, "
+            f"consider an eager loading strategy"
+        )
+        if self.raise_error:
+            raise NPlusOneError(message)
+        warnings.warn(message, NPlusOneWarning, stacklevel=common.user_stacklevel(__file__))
@@ -2,9 +2,21 @@
 # https://www.tutorialspoint.com/sqlalchemy/sqlalchemy_core_connecting_to_database.htm
 ########################################################################################################################
 import sqlalchemy
-import os
 import json
 import pprint
+import sys
+import collections
+import collections.abc
+import itertools
+import random
+import time
+
+import bootstrap
+import common
+import poolstats
+import prepared
+import resultcache
+import search
 
 
 def banner(text):
@@ -30,6 +42,53 @@ def print_results(results, title="RESULTS"):
         print(f"{title}| ", row)
 
 
+StreamSummary = collections.namedtuple("StreamSummary", "rows bytes elapsed")
+
+
+def stream_results(results, title="RESULTS", chunk_size=1000, out=None):
+    """
+    prints formatted rows in results, chunk_size rows at a time
+
+    unlike print_results the rows are never collected in a list, so memory
+    stays bounded by chunk_size whatever the size of the result
+
+    :param results:
+    :param title:
+    :param chunk_size:
+    :param out: file like object, defaults to sys.stdout
+    :return: StreamSummary(rows, bytes, elapsed)
+    """
+    out = out if out is not None else sys.stdout
+    start = time.perf_counter()
+    rows = 0
+    written = 0
+    for partition in results.partitions(chunk_size):
+        text = "".join(f"{title}| {row}\n" for row in partition)
+        out.write(text)
+        rows += len(partition)
+        written += len(text.encode())
+    return StreamSummary(rows, written, time.perf_counter() - start)
+
+
+def stream_query(connection, select, title, chunk_size=1000):
+    """
+    executes select with a server side cursor and streams its rows
+
+    :param connection:
+    :param select:
+    :param title:
+    :param chunk_size:
+    :return: StreamSummary(rows, bytes, elapsed)
+    """
+    banner(title)
+    results = connection.execute(
+        select.execution_options(stream_results=True, max_row_buffer=chunk_size)
+    )
+    summary = stream_results(results, title, chunk_size)
+    print(80 * "#")
+    return summary
+
+
 def print_query(select, title):
     """
     print select output
@@ -63,7 +122,94 @@ def selectalltext():
     print_query(select, "SELECT ALL TEXT")
 
 
-def execute_decorator(f):
+TRACE_OFF = "off"            # pass-through: the wrapped function is returned unchanged
+TRACE_VERBOSE = "verbose"    # print args, params and every row (tutorial mode)
+TRACE_SAMPLED = "sampled"    # collect QueryTrace records for a sample of the calls
+
+traces = collections.deque(maxlen=1000)
+
+
+class QueryTrace:
+    """
+    structured record of one traced execution
+
+    sql and params are copied out of the execution context, which reuses the
+    statement the engine already compiled instead of compiling it again; the
+    context itself is not kept, it references the cursor and the connection
+    """
+    __slots__ = ("sql", "params", "rowcount", "elapsed")
+
+    def __init__(self, sql, params, rowcount, elapsed):
+        self.sql = sql
+        self.params = params
+        self.rowcount = rowcount
+        self.elapsed = elapsed
+
+    @classmethod
+    def from_context(cls, context, elapsed, rowcount):
+        parameters = getattr(context, "compiled_parameters", None)
+        if parameters is None:
+            # driver sql, nothing compiled: the DBAPI parameters, a tuple or a dict each
+            parameters = context.parameters
+        params = [dict(p) if isinstance(p, collections.abc.Mapping) else tuple(p) for p in parameters]
+        return cls(context.statement, params[0] if len(params) == 1 else params, rowcount, elapsed)
+
+    def as_dict(self):
+        return dict(sql=self.sql, params=self.params, rowcount=self.rowcount, elapsed=self.elapsed)
+
+    def __repr__(self):
+        return f"QueryTrace(sql={self.sql!r}, params={self.params!r}, rowcount={self.rowcount}, elapsed={self.elapsed:.6f})"
+
+
+def execute_decorator(f, mode=TRACE_VERBOSE, sample_rate=1.0, sink=None, count_rows=False):
+    """
+    wraps conn.execute according to mode
+
+    TRACE_OFF returns f itself, TRACE_VERBOSE prints everything and returns a frozen copy of the rows,
+    TRACE_SAMPLED appends a QueryTrace to traces (or passes it to sink) for a
+    sample_rate fraction of the calls, without touching the rows
+
+    rowcount is the cursor rowcount of the statements that do not return rows;
+    a select has to be fetched to be counted: with count_rows its sampled calls
+    are buffered and the caller gets the buffered rows, otherwise it is traced as None
+
+    :param f:
+    :param mode:
+    :param sample_rate:
+    :param sink:
+    :param count_rows: buffer the sampled selects to count their rows
+    :return:
+    """
+    if mode == TRACE_OFF:
+        return f
+
+    if mode == TRACE_SAMPLED:
+        collect = sink if sink is not None else traces.append
+
+        def sampled_wrapper(*args, **kwargs):
+            if sample_rate < 1.0 and random.random() >= sample_rate:
+                return f(*args, **kwargs)
+
+            start = time.perf_counter()
+            result = f(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            context = getattr(result, "context", None)
+            if context is not None:
+                rowcount = None
+                if not result.returns_rows:
+                    rowcount = result.rowcount
+                elif count_rows:
+                    frozen = result.freeze()
+                    rowcount = len(frozen.data)
+                    result = frozen()
+                collect(QueryTrace.from_context(context, elapsed, rowcount))
+            return result
+
+        return sampled_wrapper
+
+    if mode != TRACE_VERBOSE:
+        raise ValueError(f"unknown trace mode: {mode!r}")
+
     def execute_wrapper(*args, **kwargs):
         print("-" * 80)
 
@@ -84,15 +230,17 @@ def execute_decorator(f):
         if len(args):
             query = args[0]
             print("QUERY | ", query)
-            print("PARAMS| ", query.compile().params)
+            compiled = query if isinstance(query, sqlalchemy.sql.compiler.Compiled) else query.compile()
+            print("PARAMS| ", compiled.params)
 
         print("-" * 80)
 
         result = f(*args, **kwargs)
-        try:
-            print_results(result)
-        except sqlalchemy.exc.ResourceClosedError:
-            pass
+        if result.returns_rows:
+            # printing consumes the rows, the caller gets a fresh copy
+            frozen = result.freeze()
+            print_results(frozen())
+            result = frozen()
         print("-" * 80)
 
         return result
@@ -100,22 +248,105 @@ def execute_decorator(f):
     return execute_wrapper
 
 
+BatchReport = collections.namedtuple("BatchReport", "batch rows elapsed rows_per_second")
+
+BULK_EXECUTEMANY = "executemany"  # one statement, DBAPI cursor.executemany()
+BULK_VALUES = "values"            # one INSERT ... VALUES (...), (...), ... per batch
+
+# lowest SQLITE_MAX_VARIABLE_NUMBER across sqlite versions (999 before 3.32)
+SQLITE_MAX_VARIABLES = 999
+
+
+def bulk_insert(engine, table, rows, chunk_size=10000, method=BULK_EXECUTEMANY, report=None):
+    """
+    inserts rows (any iterable of dicts, generators included) in batches of
+    chunk_size, each batch in its own transaction
+
+    BULK_VALUES needs dialect.supports_multivalues_insert and is split so that
+    a statement never exceeds the bound parameters limit, otherwise
+    BULK_EXECUTEMANY is used
+
+    :param engine:
+    :param table:
+    :param rows:
+    :param chunk_size:
+    :param method:
+    :param report: called with a BatchReport after each batch
+    :return: list of BatchReport
+    """
+    if method == BULK_VALUES and not engine.dialect.supports_multivalues_insert:
+        method = BULK_EXECUTEMANY
+
+    insert = table.insert()
+    reports = []
+    rows = iter(rows)
+    for batch_number in itertools.count(1):
+        batch = list(itertools.islice(rows, chunk_size))
+        if not batch:
+            break
+
+        start = time.perf_counter()
+        with engine.begin() as connection:
+            if method == BULK_VALUES:
+                per_statement = max(1, SQLITE_MAX_VARIABLES // len(batch[0]))
+                for offset in range(0, len(batch), per_statement):
+                    connection.execute(insert.values(batch[offset:offset + per_statement]))
+            else:
+                connection.execute(insert, batch)
+        elapsed = time.perf_counter() - start
+
+        batch_report = BatchReport(batch_number, len(batch), elapsed, len(batch) / elapsed if elapsed else float("inf"))
+        reports.append(batch_report)
+        if report is not None:
+            report(batch_report)
+    return reports
+
+
+#
+#   the parameterized text queries below, compiled once per dialect
+#
+queries = prepared.PreparedQueries()
+queries.define(
+    "student_by_name",
+    "select name, students.lastname from students where name = :name",
+    dict(name=sqlalchemy.String)
+)
+queries.define(
+    "students_between",
+    sqlalchemy.sql.select(
+        sqlalchemy.sql.text("name, students.lastname from students")
+    ).where(
+        prepared.text("name between :start and :stop", start=sqlalchemy.String, stop=sqlalchemy.String)
+    )
+)
+queries.define(
+    "students_between_after",
+    sqlalchemy.sql.select(
+        sqlalchemy.sql.text("name, students.lastname from students")
+    ).where(
+        sqlalchemy.and_(
+            prepared.text("name between :start and :stop", start=sqlalchemy.String, stop=sqlalchemy.String),
+            prepared.text("id > :id", id=sqlalchemy.Integer),
+        )
+    )
+)
+
 DB_FILENAME = 'college.db'
 
 
 def reset():
-    # start from scratch
-    try:
-        os.remove(DB_FILENAME)
-    except FileNotFoundError:
-        pass
-
-
-def create_engine():
-    # create engine
-    engine = sqlalchemy.create_engine(
-        f'sqlite:///{DB_FILENAME}',  # db file
-        echo=True  # log sql statements
+    # start from scratch, on the schema of the empty seed set
+    common.resetdb(DB_FILENAME, seed="empty")
+
+
+def create_engine(profile=common.DEFAULT_PROFILE, debug=None, **pool):
+    # create engine, with the profile shared by all scripts
+    # pool: pool configuration, like poolstats.pool_options(size=10, pre_ping=True)
+    engine = common.create_sqlite_engine(
+        DB_FILENAME,  # db file
+        profile=profile,  # PRAGMAs and pool class
+        debug=debug,  # log sql statements, default common.debug_requested()
+        **pool
     )
     # print engine property
     print("engine.driver: ", engine.driver)
@@ -129,9 +360,9 @@ def create_engine():
     return engine
 
 
-def create_tables(engine, meta):
+def define_tables(meta):
     ########################################################################################################################
-    # CREATE TABLE AND UPDATE METADATA
+    # UPDATE METADATA
     ########################################################################################################################
     students = sqlalchemy.Table(
         'students',  # table name
@@ -151,17 +382,26 @@ def create_tables(engine, meta):
         sqlalchemy.Column('st_id', sqlalchemy.Integer, sqlalchemy.ForeignKey('students.id')),
         sqlalchemy.Column('postal_add', sqlalchemy.String),
         sqlalchemy.Column('email_add', sqlalchemy.String))
+    return students, addresses
+
+
+def create_tables(engine, meta):
+    ########################################################################################################################
+    # CREATE TABLE AND UPDATE METADATA
+    ########################################################################################################################
+    students, addresses = define_tables(meta)
 
-    # create all tables
+    # create all tables, unless the db already has them
     banner("CREATE ALL")
-    meta.create_all(engine)
+    bootstrap.ensure_schema(engine, meta)
     return students, addresses
 
 
 if __name__ == '__main__':
 
     reset()
-    engine = create_engine()
+    engine = create_engine(**poolstats.pool_options(size=2, overflow=2, pre_ping=True, lifo=True))
+    pool_monitor = poolstats.PoolMonitor(engine)
     # metadata object: contains all the definitions
     meta = sqlalchemy.MetaData()
     students, addresses = create_tables(engine, meta)
@@ -170,10 +410,12 @@ if __name__ == '__main__':
     # TRY REFLECTION
     ########################################################################################################################
     # create inspector to list tables
-    inspector: sqlalchemy.engine.reflection.Inspector = sqlalchemy.inspect(engine)
-    tablenames = inspector.get_table_names()
-    print("type(inspector.get_table_names()): ", type(tablenames))
-    print("inspector.get_table_names(): ", tablenames)
+    # inspector: sqlalchemy.engine.reflection.Inspector = sqlalchemy.inspect(engine)
+    # tablenames = inspector.get_table_names()
+    # reflected MetaData, cached next to the db until its schema changes
+    tablenames = sorted(bootstrap.reflect(engine).tables)
+    print("type(tablenames): ", type(tablenames))
+    print("reflected tablenames: ", tablenames)
 
     tablenames = meta.tables
     banner("TABLE NAMES")
@@ -219,6 +461,11 @@ if __name__ == '__main__':
     ########################################################################################################################
     selectall_orm(students)
 
+    # stream records in chunks, on a connection that is not traced
+    with engine.connect() as stream_conn:
+        summary = stream_query(stream_conn, students.select(), "SELECT ALL STREAM", chunk_size=2)
+    print("summary: ", summary)
+
     # select records where
     select = students.select().where(students.c.id > 2)
     print_query(select, "SELECT WHERE")
@@ -290,20 +537,50 @@ if __name__ == '__main__':
     ########################################################################################################################
     # print(result.fetchone())
     # print(result.fetchall())
-    # ResultProxy is closed now
+    # ResultProxy is consumed once read
     ########################################################################################################################
-    # TypeError: can only concatenate tuple (not "NoneType") to tuple
-    # frozen = result.freeze()
-    # results = frozen()
-    # exit()
+    # freeze() failed here (TypeError: can only concatenate tuple (not "NoneType") to tuple)
+    # because execute_wrapper had already consumed the result: now it returns a fresh one
     ########################################################################################################################
-    # so we use lists...
-    frozen = list(result)
-    print(frozen)
+    frozen = result.freeze()
+    print(frozen().all())
 
-    for row in frozen:
+    for row in frozen():
         print(row)
 
+    ########################################################################################################################
+    # SAMPLED TRACES
+    ########################################################################################################################
+    banner("SAMPLED TRACES")
+    with engine.connect() as trace_conn:
+        execute = execute_decorator(trace_conn.execute, mode=TRACE_SAMPLED, count_rows=True)
+        exec_driver_sql = execute_decorator(trace_conn.exec_driver_sql, mode=TRACE_SAMPLED, count_rows=True)
+        print(execute(sqlalchemy.sql.text("select name from students where id > :id"), dict(id=2)).all())
+        print(exec_driver_sql("select name from students where id > ?", (2,)).all())
+        print(exec_driver_sql("select 1").all())
+    for trace in list(traces)[-3:]:
+        print(trace)
+
+    ########################################################################################################################
+    # RESULT CACHE
+    ########################################################################################################################
+    banner("RESULT CACHE")
+    result_cache = resultcache.ResultCache(max_bytes=1024 * 1024).install(engine)
+    select = students.select().where(students.c.id > 2)
+    for _ in range(3):
+        result = result_cache.execute(conn, select)
+    print("result_cache.stats: ", result_cache.stats)
+
+    ########################################################################################################################
+    # PREPARED QUERIES
+    ########################################################################################################################
+    banner("PREPARED QUERIES")
+    queries.execute(conn, "student_by_name", dict(name="fab"))
+    queries.execute(conn, "students_between", dict(start="b", stop="t"))
+    queries.execute(conn, "students_between_after", dict(start="b", stop="t", id=2))
+    queries.execute(conn, "student_by_name", dict(name="one"))
+    print("queries.stats: ", queries.stats)
+
     ########################################################################################################################
     # ALIASES
     ########################################################################################################################
@@ -326,6 +603,9 @@ if __name__ == '__main__':
     )
     conn.execute(update)
     selectall_orm(students)
+    # the update dropped the cached students results
+    result = result_cache.execute(conn, students.select().where(students.c.id > 2))
+    print("result_cache.stats: ", result_cache.stats)
 
     ########################################################################################################################
     # DELETE
@@ -362,3 +642,28 @@ if __name__ == '__main__':
     conn.execute(select)
     # TODO: and, or, join, union, except, ...
 
+    ########################################################################################################################
+    # BULK INSERT
+    ########################################################################################################################
+    banner("BULK INSERT")
+    generated = (dict(name=f"name{n}", lastname=f"lastname{n}") for n in range(10000))
+    reports = bulk_insert(engine, students, generated, chunk_size=2500, report=print)
+    print("rows: ", sum(report.rows for report in reports))
+
+    ########################################################################################################################
+    # FULL TEXT
+    ########################################################################################################################
+    banner("FULL TEXT")
+    students_fts, addresses_fts = search.college_indexes(students, addresses)
+    students_fts.create(engine)  # indexes the rows already there, triggers index the next ones
+    addresses_fts.create(engine)
+    conn.execute(students_fts.statement(students, "mandal", limit=5))
+    conn.execute(addresses_fts.statement(addresses, "server.com", columns=("email_add",)))
+
+    ########################################################################################################################
+    # POOL
+    ########################################################################################################################
+    banner("POOL")
+    conn.close()
+    pool_monitor.log_leaks()
+    pprint.pprint(pool_monitor.stats)
@@ -0,0 +1,255 @@
+########################################################################################################################
+# asyncio versions of the main.py and main_declarative.py workflows, on aiosqlite
+# https://docs.sqlalchemy.org/en/14/orm/extensions/asyncio.html
+########################################################################################################################
+import asyncio
+import logging
+import random
+import time
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import sessionmaker
+
+import common
+import main
+from main import (
+    TRACE_OFF,
+    TRACE_SAMPLED,
+    TRACE_VERBOSE,
+    QueryTrace,
+    banner,
+    print_results
+)
+from models import (
+    Base,
+    Customers
+)
+
+DB_FILENAME = 'college_async.db'
+
+
+def create_engine(profile=common.DEFAULT_PROFILE, debug=None, **pool):
+    # create async engine, with the profile shared by all scripts
+    return common.create_sqlite_async_engine(
+        DB_FILENAME,  # db file
+        profile=profile,  # PRAGMAs and pool class
+        debug=debug,  # log sql statements, default common.debug_requested()
+        **pool
+    )
+
+
+def execute_decorator(f, mode=TRACE_VERBOSE, sample_rate=1.0, sink=None):
+    """
+    main.execute_decorator for AsyncConnection.execute
+
+    the rows of AsyncConnection.execute are buffered already, so selects are
+    always counted
+
+    :param f:
+    :param mode:
+    :param sample_rate:
+    :param sink:
+    :return:
+    """
+    if mode == TRACE_OFF:
+        return f
+
+    if mode == TRACE_SAMPLED:
+        collect = sink if sink is not None else main.traces.append
+
+        async def sampled_wrapper(*args, **kwargs):
+            if sample_rate < 1.0 and random.random() >= sample_rate:
+                return await f(*args, **kwargs)
+
+            start = time.perf_counter()
+            result = await f(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            context = getattr(result, "context", None)
+            if context is not None:
+                if result.returns_rows:
+                    frozen = result.freeze()
+                    rowcount = len(frozen.data)
+                    result = frozen()
+                else:
+                    rowcount = result.rowcount
+                collect(QueryTrace.from_context(context, elapsed, rowcount))
+            return result
+
+        return sampled_wrapper
+
+    if mode != TRACE_VERBOSE:
+        raise ValueError(f"unknown trace mode: {mode!r}")
+
+    async def execute_wrapper(*args, **kwargs):
+        print("-" * 80)
+        print("ARGS  | ", args)
+        print("KWARGS| ", kwargs)
+        print("-" * 80)
+
+        result = await f(*args, **kwargs)
+        if result.returns_rows:
+            # printing consumes the rows, the caller gets a fresh copy
+            frozen = result.freeze()
+            print_results(frozen())
+            result = frozen()
+        print("-" * 80)
+
+        return result
+
+    return execute_wrapper
+
+
+async def log_rows(rows, batch_size=1):
+    """
+    common.log_rows for AsyncResult, the rows are streamed batch_size at a time
+
+    :param rows: AsyncResult, from AsyncConnection.stream() or AsyncSession.stream(), or a list
+    :param batch_size: rows per log record
+    :return:
+    """
+    if not common.external_logger.isEnabledFor(logging.INFO):
+        return
+
+    if isinstance(rows, list):
+        common.log_rows(rows, batch_size)
+        return
+
+    async for partition in rows.partitions(batch_size):
+        common.external_logger.info("\n".join(common.ROW_FORMAT.format(row=row) for row in partition))
+
+
+async def stream_query(connection, select, title, chunk_size=1000):
+    """
+    main.stream_query on an AsyncConnection: the rows come from a server side cursor
+
+    :param connection:
+    :param select:
+    :param title:
+    :param chunk_size:
+    :return: StreamSummary(rows, bytes, elapsed)
+    """
+    banner(title)
+    start = time.perf_counter()
+    rows = 0
+    written = 0
+    results = await connection.stream(select.execution_options(max_row_buffer=chunk_size))
+    async for partition in results.partitions(chunk_size):
+        text = "".join(f"{title}| {row}\n" for row in partition)
+        print(text, end="")
+        rows += len(partition)
+        written += len(text.encode())
+    print(80 * "#")
+    return main.StreamSummary(rows, written, time.perf_counter() - start)
+
+
+async def fan_out(engine, statements, concurrency=10):
+    """
+    runs statements concurrently, each one on its own connection, at most concurrency at a time
+
+    :param engine:
+    :param statements: (statement, params) pairs
+    :param concurrency:
+    :return: list of row lists, in the order of statements
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(statement, params):
+        async with semaphore:
+            async with engine.connect() as connection:
+                result = await connection.execute(statement, params)
+                return result.all()
+
+    return await asyncio.gather(*[run(statement, params) for statement, params in statements])
+
+
+async def crud(engine):
+    """
+    the main.py Core walkthrough, shortened
+    """
+    meta = sqlalchemy.MetaData()
+    async with engine.begin() as conn:
+        students, addresses = await conn.run_sync(lambda sync_conn: main.create_tables(sync_conn, meta))
+
+    async with engine.begin() as conn:
+        # AsyncConnection has __slots__, the wrapper cannot replace conn.execute
+        execute = execute_decorator(conn.execute)
+
+        banner("MULTIPLE INSERT")
+        await execute(students.insert(), [
+            dict(name='fab', lastname='cat'),
+            dict(name='one', lastname='guy'),
+            dict(name='the', lastname='mandalorian'),
+            dict(name='darth', lastname='vader'),
+        ])
+
+        banner("SELECT WHERE")
+        await execute(students.select().where(students.c.id > 2))
+
+        banner("UPDATE")
+        await execute(students.update().where(students.c.lastname == 'cat').values(lastname='boss'))
+
+        banner("DELETE")
+        await execute(students.delete().where(students.c.lastname == "guy"))
+
+    async with engine.connect() as conn:
+        summary = await stream_query(conn, students.select(), "SELECT ALL STREAM", chunk_size=2)
+    print("summary: ", summary)
+
+    banner("FAN OUT")
+    results = await fan_out(engine, [(students.select().where(students.c.id == key), {}) for key in range(1, 5)])
+    print("results: ", results)
+
+
+async def sessions(engine, log):
+    """
+    the main_declarative.py session walkthrough, shortened
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    Session = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    async with Session() as session:
+        log.info("add records")
+        session.add(Customers(name="Fab", address="meow street 9", email="fab@meow.com"))
+        session.add_all([
+            Customers(name="robb", address="here", email="email@gmail.com"),
+            Customers(name="frank", address="castiglione", email="punisher@gmail.com"),
+        ])
+        await session.commit()
+
+        log.info("QUERY ALL")
+        await log_rows((await session.execute(select(Customers))).scalars().all())
+
+        log.info("GET")
+        row = await session.get(Customers, 2)
+        await log_rows([row])
+        row.address = "flamingo road"
+        await session.commit()
+
+        log.info("FILTER, STREAMED")
+        await log_rows((await session.stream(select(Customers).where(Customers.id != 2))).scalars(), batch_size=10)
+
+        log.info("BULK UPDATE")
+        await session.execute(
+            sqlalchemy.update(Customers).where(Customers.id != 2).values(name="Mr." + Customers.name),
+            execution_options=dict(synchronize_session=False)
+        )
+        await session.commit()
+        await log_rows((await session.execute(select(Customers))).scalars().all())
+
+
+async def walkthrough():
+    common.resetdb(DB_FILENAME, seed="empty")
+    engine = create_engine()
+    common.fix_loggers()
+    await crud(engine)
+    await sessions(engine, common.external_logger)
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=common.LOGGER_FORMAT)
+    common.setlogger(logging.getLogger(__name__))
+    asyncio.run(walkthrough())
@@ -1,18 +1,26 @@
-from sqlalchemy import (
-    create_engine,
-    Column,
-    Integer,
-    String
-)
-from sqlalchemy.ext.declarative import declarative_base
 import sqlalchemy
 import logging
 from common import (
     LOGGER_FORMAT,
+    ROW_COLUMNS,
     fix_loggers,
     log_rows,
     setlogger,
-    resetdb
+    resetdb,
+    create_sqlite_engine
+)
+from models import (
+    Base,
+    Customers
+)
+from bootstrap import ensure_schema
+from pagination import pages
+from pkcache import PrimaryKeyCache
+from projection import read
+from search import CUSTOMERS as CUSTOMERS_FTS
+from mutations import (
+    SYNC_EVALUATE,
+    bulk_update
 )
 
 logging.basicConfig(
@@ -26,35 +34,20 @@ logging.basicConfig(
 log = setlogger(logging.getLogger(__name__))
 
 DB_FILENAME = "sales.db"
-resetdb(DB_FILENAME)
+resetdb(DB_FILENAME, seed="tutorial")
 #
 #   create engine and logger
 #
-engine = create_engine(f"sqlite:///{DB_FILENAME}", echo=True)
+engine = create_sqlite_engine(DB_FILENAME)  # sql echo with --debug or SQL_DEBUG=1
 #
 #   disable all handlers except root, after logger creation
 #
 fix_loggers()
 #
-#   obtain base class
-#
-Base = declarative_base()
-
-
+#   Base and Customers are defined in models.py
 #
-#   define class
-#
-class Customers(Base):
-    __tablename__ = 'customers'
-
-    id = Column(Integer, primary_key=True)
-    name = Column(String)
-    address = Column(String)
-    email = Column(String)
-
-
 log.info("create_all")
-Base.metadata.create_all(engine)
+ensure_schema(engine, Base.metadata)
 ########################################################################################################################
 #   create session
 ########################################################################################################################
@@ -65,22 +58,24 @@ session: sqlalchemy.orm.session.Session = Session()
 ########################################################################################################################
 #   ADD/INSERT
 ########################################################################################################################
-
-customer = Customers(
-    name="Fab",
-    address="meow street 9",
-    email="fab@meow.com"
-)
-
-session.add(customer)
-session.commit()
-
-log.info("add records")
-session.add_all([
-    Customers(name="robb", address="here", email="email@gmail.com"),
-    Customers(name="frank", address="castiglione", email="punisher@gmail.com"),
-])
-session.commit()
+#
+#   Fab, robb and frank come from the "tutorial" seed set (fixtures.tutorial),
+#   cloned by resetdb; added one by one they would be:
+#
+# customer = Customers(
+#     name="Fab",
+#     address="meow street 9",
+#     email="fab@meow.com"
+# )
+#
+# session.add(customer)
+# session.commit()
+#
+# session.add_all([
+#     Customers(name="robb", address="here", email="email@gmail.com"),
+#     Customers(name="frank", address="castiglione", email="punisher@gmail.com"),
+# ])
+# session.commit()
 
 ########################################################################################################################
 #   SELECT
@@ -90,6 +85,13 @@ query = session.query(Customers)
 log.info(query)
 result = query.all()
 log_rows(result)
+
+log.info("QUERY ALL, BATCHED AND PROJECTED")
+log_rows(session.query(Customers), batch_size=100, columns=ROW_COLUMNS)
+
+log.info("QUERY ALL, LIGHTWEIGHT RECORDS")
+# namedtuples from the Result rows, nothing enters the identity map
+log_rows(read(session, Customers, Customers.id != 2), batch_size=100)
 ########################################################################################################################
 #   UPDATE
 ########################################################################################################################
@@ -100,6 +102,15 @@ log.info("UPDATE")
 row.address = "flamingo road"
 session.commit()
 ########################################################################################################################
+#   PRIMARY KEY CACHE
+########################################################################################################################
+log.info("PK CACHE")
+pk_cache = PrimaryKeyCache(maxsize=1000, ttl=60).install(Session)
+for _ in range(3):
+    with Session() as short_lived:
+        log_rows(pk_cache.get(short_lived, Customers, 2))
+log.info(f"pk_cache.stats: {pk_cache.stats}")
+########################################################################################################################
 #   FIRST, EDIT, ROLLBACK
 ########################################################################################################################
 log.info("GET FIRST")
@@ -133,6 +144,17 @@ log_rows(objects)
 
 records = session.query(Customers).all()
 log_rows(records)
+
+log.info("BULK UPDATE")
+reports = bulk_update(
+    session,
+    Customers,
+    [(1, {"email": "fab@purr.com"}), (3, {"address": "castle", "email": "frank@purr.com"})],
+    synchronize_session=SYNC_EVALUATE
+)
+log.info(f"UPDATED {sum(report.rows for report in reports)} records, in memory objects are in sync")
+log_rows(records)
+session.commit()
 ########################################################################################################################
 #   FILTERS
 ########################################################################################################################
@@ -148,6 +170,12 @@ log.info("LIKE")
 records = session.query(Customers).filter(Customers.name.like("%Fa%"))
 log_rows(records)
 
+log.info("FULL TEXT")
+# FTS5 trigram index, ranked by bm25, in place of the LIKE scans
+CUSTOMERS_FTS.create(engine)
+log_rows(CUSTOMERS_FTS.search(session, Customers, "rob"))
+log_rows(CUSTOMERS_FTS.search(session, Customers, "gmail", columns=("email",)))
+
 log.info("IN")
 records = session.query(Customers).filter(Customers.id.in_([1,3]))
 log_rows(records)
@@ -172,3 +200,10 @@ records = session.query(Customers).filter(
     )
 )
 log_rows(records)
+########################################################################################################################
+#   KEYSET PAGINATION
+########################################################################################################################
+log.info("PAGES")
+for page in pages(session.query(Customers).filter(Customers.id != 2), [Customers.id], page_size=1):
+    log_rows(page.rows)
+    log.info(f"cursor: {page.cursor}")
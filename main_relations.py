@@ -1,10 +1,3 @@
-from sqlalchemy import (
-    create_engine,
-    Column,
-    Integer,
-    String
-)
-from sqlalchemy.ext.declarative import declarative_base
 import sqlalchemy
 import logging
 from common import (
@@ -12,7 +5,20 @@ from common import (
     fix_loggers,
     log_rows,
     setlogger,
-    resetdb
+    resetdb,
+    create_sqlite_engine
+)
+from bootstrap import ensure_schema
+from loading import (
+    NPlusOneDetector,
+    load
+)
+from unitofwork import BulkWriter
+from aggregates import TOTALS
+from models import (
+    Base,
+    Customers,
+    Invoice
 )
 
 logging.basicConfig(
@@ -26,54 +32,25 @@ logging.basicConfig(
 log = setlogger(logging.getLogger(__name__))
 
 DB_FILENAME = "sales.db"
-resetdb(DB_FILENAME)
+resetdb(DB_FILENAME, seed="tutorial")
 #
 #   create engine and logger
 #
-engine = create_engine(f"sqlite:///{DB_FILENAME}", echo=True)
+engine = create_sqlite_engine(DB_FILENAME)  # sql echo with --debug or SQL_DEBUG=1
 #
 #   disable all handlers except root, after logger creation
 #
 fix_loggers()
 #
-#   obtain base class
+#   Base, Customers and Invoice, with the Customers.invoices/Invoice.customer
+#   relationship, are defined in models.py
 #
-Base = declarative_base()
-
-
+log.info("create_all")
+ensure_schema(engine, Base.metadata)
 #
-#   define class
+#   per customer invoice count and amount, maintained from here on
 #
-class Customers(Base):
-    __tablename__ = 'customers'
-
-    id = Column(Integer, primary_key=True)
-    name = Column(String)
-    address = Column(String)
-    email = Column(String)
-
-
-class Invoice(Base):
-    __tablename__ = "invoices"
-
-    id = Column(Integer, primary_key=True)
-    custid = Column(Integer, sqlalchemy.ForeignKey('customers.id'))
-    invno = Column(Integer)
-    amount = Column(Integer)
-    customer = sqlalchemy.orm.relationship(
-        "Customer",
-        back_populates="invoices"
-    )
-
-
-Customers.invoices = sqlalchemy.orm.relationship(
-    "Invoice",
-    order_by=Invoice.id,
-    back_populates="customers"
-)
-log.info("create_all")
-Base.metadata.create_all(engine)
-exit()
+TOTALS.create(engine)
 
 #
 #   create session
@@ -81,23 +58,76 @@ exit()
 from sqlalchemy.orm import sessionmaker
 
 Session = sessionmaker(bind=engine)
+TOTALS.install(engine, Session)
 session: sqlalchemy.orm.session.Session = Session()
-customer = Customers(
-    name="Fab",
-    address="meow street 9",
-    email="fab@meow.com"
-)
-
-session.add(customer)
-session.commit()
-
-log.info("add records")
-session.add_all([
-    Customers(name="robb", address="here", email="email@gmail.com"),
-    Customers(name="frank", address="castiglione", email="punisher@gmail.com"),
-])
+#
+#   Fab, robb and frank, with 3 invoices each, come from the "tutorial" seed
+#   set (fixtures.tutorial), cloned by resetdb; added here they would be:
+#
+# session.add_all([
+#     Customers(name="Fab", address="meow street 9", email="fab@meow.com"),
+#     Customers(name="robb", address="here", email="email@gmail.com"),
+#     Customers(name="frank", address="castiglione", email="punisher@gmail.com"),
+# ])
+# for custid in 1, 2, 3:
+#     session.add_all([
+#         Invoice(custid=custid, invno=custid * 10 + n, amount=custid * 1000 + n * 100)
+#         for n in range(3)
+#     ])
+# session.commit()
+########################################################################################################################
+#   LOADING STRATEGIES
+########################################################################################################################
+#
+#   warn when a session issues 3 lazy loads in one unit of work
+#
+detector = NPlusOneDetector(threshold=3).install(Session)
+
+for strategy in "select", "selectin", "joined", "subquery":
+    log.info(f"LOAD {strategy}")
+    session.expunge_all()
+    for customer in session.query(Customers).options(load(Customers.invoices, strategy)):
+        log.info(f"{customer.name}: {[invoice.invno for invoice in customer.invoices]}")
+    log.info(f"lazy loads: {detector.count(session)}")
+    session.rollback()
+
+log.info("LOAD raise")
+session.expunge_all()
+customer = session.query(Customers).options(load(Customers.invoices, "raise")).first()
+try:
+    customer.invoices
+except sqlalchemy.exc.InvalidRequestError as e:
+    log.info(e)
+session.rollback()
+########################################################################################################################
+#   BULK ADD
+########################################################################################################################
+#
+#   related objects written in chunks of batched inserts, custid comes from
+#   Customers.invoices, the identity map is emptied after each chunk
+#
+log.info("BULK ADD")
+with BulkWriter(session, chunk_size=40, report=log.info) as writer:
+    for n in range(25):
+        customer = Customers(name=f"bulk{n}", address=f"street {n}", email=f"bulk{n}@mail.com")
+        customer.invoices = [Invoice(invno=n * 10 + i, amount=n * 100 + i) for i in range(3)]
+        writer.add(customer)
 session.commit()
+log.info(f"customers: {session.query(Customers).count()}, invoices: {session.query(Invoice).count()}")
+########################################################################################################################
+#   INVOICE TOTALS
+########################################################################################################################
+#
+#   one row per customer, no GROUP BY over invoices
 #
+log.info("INVOICE TOTALS")
+invoice = session.query(Invoice).filter(Invoice.custid == 1).first()
+invoice.amount += 500
+session.delete(session.query(Invoice).filter(Invoice.custid == 2).first())
+session.commit()
+for row in TOTALS.totals(session)[:5]:
+    log.info(f"{row.id:2d} {row.name:<6s} invoices={row.invoices} amount={row.amount}")
+log.info(f"mismatches: {TOTALS.check(session)}")
 
 # TODO: continue lesson: https://www.tutorialspoint.com/sqlalchemy/sqlalchemy_orm_working_with_related_objects.htm
 
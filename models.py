@@ -0,0 +1,48 @@
+"""
+declarative models shared by the ORM scripts, benchmarks and tools
+"""
+from sqlalchemy import (
+    Column,
+    Integer,
+    String
+)
+import sqlalchemy
+import sqlalchemy.orm
+
+#
+#   obtain base class
+#
+# sqlalchemy.orm.declarative_base, the sqlalchemy.ext.declarative import is slower
+Base = sqlalchemy.orm.declarative_base()
+
+
+#
+#   define class
+#
+class Customers(Base):
+    __tablename__ = 'customers'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    address = Column(String)
+    email = Column(String)
+
+
+class Invoice(Base):
+    __tablename__ = "invoices"
+
+    id = Column(Integer, primary_key=True)
+    custid = Column(Integer, sqlalchemy.ForeignKey('customers.id'))
+    invno = Column(Integer)
+    amount = Column(Integer)
+    customer = sqlalchemy.orm.relationship(
+        "Customers",
+        back_populates="invoices"
+    )
+
+
+Customers.invoices = sqlalchemy.orm.relationship(
+    "Invoice",
+    order_by=Invoice.id,
+    back_populates="customer"
+)
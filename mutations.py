@@ -0,0 +1,217 @@
+"""
+set based bulk update/delete by primary key, with a choice of identity map synchronization
+"""
+import collections
+import itertools
+import time
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+
+MutationReport = collections.namedtuple("MutationReport", "batch rows elapsed")
+
+SYNC_EVALUATE = "evaluate"  # apply the new values to the objects in the identity map
+SYNC_FETCH = "fetch"        # reload the changed rows of the objects in the identity map
+SYNC_EXPIRE = "expire"      # expire the changed attributes, reloaded on next access
+
+METHOD_EXECUTEMANY = "executemany"  # UPDATE ... WHERE pk = ? executed once per row by the DBAPI
+METHOD_JOIN = "join"                # rows in a temp table, one UPDATE ... FROM joined to it, sqlite >= 3.33
+
+SYNCHRONIZE_SESSION = (SYNC_EVALUATE, SYNC_FETCH, SYNC_EXPIRE, False, None)
+UPDATE_FROM_VERSION = (3, 33)       # first sqlite with UPDATE ... FROM
+
+
+def _split(session, entity):
+    """
+    returns (connection, table, primary key column, mapped class or None)
+    """
+    if isinstance(entity, sqlalchemy.Table):
+        table, mapped = entity, None
+    else:
+        table, mapped = entity.__table__, entity
+    connection = session.connection() if isinstance(session, Session) else session
+    primary_key, = table.primary_key.columns
+    return connection, table, primary_key, mapped
+
+
+def _identities(session, mapped, keys):
+    """
+    objects of mapped with a primary key in keys, already in the identity map
+    """
+    if mapped is None or not isinstance(session, Session):
+        return []
+    identities = (session.identity_map.get(identity_key(mapped, key)) for key in keys)
+    return [obj for obj in identities if obj is not None]
+
+
+def _synchronize(session, mapped, table, primary_key, batch, synchronize_session):
+    if not synchronize_session:
+        return
+
+    changes = dict(batch)
+    objects = _identities(session, mapped, changes)
+    if not objects:
+        return
+
+    mapper = sqlalchemy.inspect(mapped)
+    if synchronize_session == SYNC_EVALUATE:
+        for obj in objects:
+            for column, value in changes[mapper.primary_key_from_instance(obj)[0]].items():
+                set_committed_value(obj, mapper.get_property_by_column(table.c[column]).key, value)
+    elif synchronize_session == SYNC_FETCH:
+        keys = [mapper.primary_key_from_instance(obj)[0] for obj in objects]
+        rows = session.connection().execute(sqlalchemy.select(table).where(primary_key.in_(keys)))
+        fetched = {row._mapping[primary_key]: row._mapping for row in rows}
+        for obj in objects:
+            row = fetched[mapper.primary_key_from_instance(obj)[0]]
+            for prop in mapper.column_attrs:
+                set_committed_value(obj, prop.key, row[prop.columns[0]])
+    elif synchronize_session == SYNC_EXPIRE:
+        for obj in objects:
+            session.expire(obj, [
+                mapper.get_property_by_column(table.c[column]).key
+                for column in changes[mapper.primary_key_from_instance(obj)[0]]
+            ])
+
+
+def _update_executemany(connection, table, primary_key, batch):
+    rowcount = 0
+    # one statement per set of updated columns
+    by_columns = collections.defaultdict(list)
+    for key, values in batch:
+        by_columns[tuple(sorted(values))].append((key, values))
+
+    for columns, rows in by_columns.items():
+        update = table.update().where(
+            primary_key == sqlalchemy.bindparam("pk_")
+        ).values({
+            column: sqlalchemy.bindparam(f"v_{column}") for column in columns
+        })
+        params = [dict({f"v_{column}": values[column] for column in columns}, pk_=key) for key, values in rows]
+        rowcount += connection.execute(update, params).rowcount
+    return rowcount
+
+
+def _update_join(connection, table, primary_key, batch):
+    # sqlalchemy 1.4 does not compile UPDATE ... FROM for sqlite, the statement is written here
+    columns = sorted({column for key, values in batch for column in values})
+    changes = sqlalchemy.Table(
+        f"bulk_{table.name}", sqlalchemy.MetaData(),
+        sqlalchemy.Column("pk_", primary_key.type, primary_key=True),
+        *[sqlalchemy.Column(f"v_{column}", table.c[column].type) for column in columns],
+        *[sqlalchemy.Column(f"s_{column}", sqlalchemy.Boolean) for column in columns],
+        prefixes=["TEMPORARY"]
+    )
+    changes.create(connection)
+    try:
+        connection.execute(changes.insert(), [
+            dict(
+                pk_=key,
+                **{f"v_{column}": values.get(column) for column in columns},
+                **{f"s_{column}": column in values for column in columns}
+            )
+            for key, values in batch
+        ])
+        # columns missing from a row keep their value
+        quote = connection.dialect.identifier_preparer.quote
+        target = quote(table.name)
+        assignments = ", ".join(
+            f"{quote(column)} = CASE WHEN changes.{quote(f's_{column}')} "
+            f"THEN changes.{quote(f'v_{column}')} ELSE {target}.{quote(column)} END"
+            for column in columns
+        )
+        update = (
+            f"UPDATE {target} SET {assignments} FROM {quote(changes.name)} AS changes "
+            f"WHERE {target}.{quote(primary_key.name)} = changes.pk_"
+        )
+        return connection.exec_driver_sql(update).rowcount
+    finally:
+        changes.drop(connection)
+
+
+def bulk_update(session, entity, changes, chunk_size=1000, synchronize_session=SYNC_EVALUATE,
+                method=METHOD_EXECUTEMANY, report=None):
+    """
+    updates rows by primary key from (pk, {column: value}) pairs, chunk_size pairs per batch,
+    with set based statements instead of flushing one object at a time
+
+    synchronize_session tells what to do with the objects of those rows already
+    in the session: SYNC_EVALUATE, SYNC_FETCH, SYNC_EXPIRE or False to leave them stale
+    (SQLAlchemy 1.4 has no RETURNING for executemany, so SYNC_FETCH reselects them)
+
+    :param session: Session, or Connection when entity is a Table
+    :param entity: mapped class or Table
+    :param changes: iterable of (pk, values)
+    :param chunk_size:
+    :param synchronize_session:
+    :param method: METHOD_EXECUTEMANY or METHOD_JOIN
+    :param report: called with a MutationReport after each batch
+    :return: list of MutationReport
+    """
+    if synchronize_session not in SYNCHRONIZE_SESSION:
+        raise ValueError(f"unknown synchronize_session: {synchronize_session!r}")
+    try:
+        update = {
+            METHOD_EXECUTEMANY: _update_executemany,
+            METHOD_JOIN: _update_join,
+        }[method]
+    except KeyError:
+        raise ValueError(f"unknown method: {method!r}") from None
+    connection, table, primary_key, mapped = _split(session, entity)
+    if method == METHOD_JOIN and connection.dialect.server_version_info < UPDATE_FROM_VERSION:
+        raise ValueError(f"{METHOD_JOIN} needs sqlite {'.'.join(map(str, UPDATE_FROM_VERSION))} or later")
+
+    reports = []
+    changes = iter(changes)
+    for batch_number in itertools.count(1):
+        batch = list(itertools.islice(changes, chunk_size))
+        if not batch:
+            break
+
+        start = time.perf_counter()
+        rowcount = update(connection, table, primary_key, batch)
+        _synchronize(session, mapped, table, primary_key, batch, synchronize_session)
+        batch_report = MutationReport(batch_number, rowcount, time.perf_counter() - start)
+        reports.append(batch_report)
+        if report is not None:
+            report(batch_report)
+    return reports
+
+
+def bulk_delete(session, entity, keys, chunk_size=1000, synchronize_session=SYNC_EVALUATE, report=None):
+    """
+    deletes rows by primary key, chunk_size keys per DELETE ... WHERE pk IN (...)
+
+    with any synchronize_session the deleted objects are removed from the session
+
+    :param session: Session, or Connection when entity is a Table
+    :param entity: mapped class or Table
+    :param keys: iterable of primary keys
+    :param chunk_size:
+    :param synchronize_session:
+    :param report: called with a MutationReport after each batch
+    :return: list of MutationReport
+    """
+    if synchronize_session not in SYNCHRONIZE_SESSION:
+        raise ValueError(f"unknown synchronize_session: {synchronize_session!r}")
+    connection, table, primary_key, mapped = _split(session, entity)
+
+    reports = []
+    keys = iter(keys)
+    for batch_number in itertools.count(1):
+        batch = list(itertools.islice(keys, chunk_size))
+        if not batch:
+            break
+
+        start = time.perf_counter()
+        rowcount = connection.execute(table.delete().where(primary_key.in_(batch))).rowcount
+        if synchronize_session:
+            for obj in _identities(session, mapped, batch):
+                session.expunge(obj)
+        batch_report = MutationReport(batch_number, rowcount, time.perf_counter() - start)
+        reports.append(batch_report)
+        if report is not None:
+            report(batch_report)
+    return reports
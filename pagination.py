@@ -0,0 +1,154 @@
+"""
+keyset (seek) pagination for Core selects and ORM queries
+"""
+import base64
+import collections
+import datetime
+import decimal
+import json
+import uuid
+
+import sqlalchemy
+from sqlalchemy.orm import Query
+
+Page = collections.namedtuple("Page", "rows cursor")
+
+
+#
+#   key value types json has no type for: (type, name, to string, from string)
+#
+CURSOR_TYPES = [
+    (datetime.datetime, "datetime", datetime.datetime.isoformat, datetime.datetime.fromisoformat),
+    (datetime.date, "date", datetime.date.isoformat, datetime.date.fromisoformat),
+    (datetime.time, "time", datetime.time.isoformat, datetime.time.fromisoformat),
+    (decimal.Decimal, "decimal", str, decimal.Decimal),
+    (uuid.UUID, "uuid", str, uuid.UUID),
+    (bytes, "bytes", lambda value: base64.b64encode(value).decode(), base64.b64decode),
+]
+CURSOR_DECODERS = {name: decode for _, name, _, decode in CURSOR_TYPES}
+
+
+def _encode_value(value):
+    # datetime before date, a datetime is a date too
+    for cls, name, encode, _ in CURSOR_TYPES:
+        if isinstance(value, cls):
+            return {"$type": name, "value": encode(value)}
+    raise TypeError(f"cursor key value of type {type(value).__name__} is not supported")
+
+
+def _decode_value(obj):
+    if set(obj) == {"$type", "value"} and obj["$type"] in CURSOR_DECODERS:
+        return CURSOR_DECODERS[obj["$type"]](obj["value"])
+    return obj
+
+
+def encode_cursor(values):
+    """
+    opaque token for the key values of the last row of a page
+
+    :param values: json serializable key values, or of one of CURSOR_TYPES
+    :return:
+    """
+    text = json.dumps(values, separators=(",", ":"), default=_encode_value)
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+def decode_cursor(cursor, count):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()), object_hook=_decode_value)
+    except ValueError:
+        raise ValueError(f"invalid cursor: {cursor!r}") from None
+    if not isinstance(values, list) or len(values) != count:
+        raise ValueError(f"cursor does not match the {count} order by keys: {cursor!r}")
+    return values
+
+
+def after(keys, values, descending=False):
+    """
+    condition selecting the rows that sort after values on keys,
+    as (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ...
+
+    :param keys:
+    :param values:
+    :param descending:
+    :return:
+    """
+    clauses = []
+    for position, (key, value) in enumerate(zip(keys, values)):
+        equal = [previous == previous_value for previous, previous_value in zip(keys[:position], values[:position])]
+        clauses.append(sqlalchemy.and_(*equal, key < value if descending else key > value))
+    return sqlalchemy.or_(*clauses)
+
+
+def key_value(row, key):
+    """
+    value of key in row, an ORM entity or a Row
+
+    :param row:
+    :param key: column, mapped attribute or labeled expression
+    :return:
+    """
+    name = key.name if isinstance(key, sqlalchemy.sql.expression.Label) else getattr(key, "key", None)
+    if isinstance(row, sqlalchemy.engine.Row):
+        mapping = row._mapping
+        if key in mapping:
+            return mapping[key]
+        if name is not None and name in mapping:
+            return mapping[name]
+    elif name is not None and hasattr(row, name):
+        return getattr(row, name)
+    raise ValueError(f"order by key {key} is not in the rows, select it, labeled if an expression")
+
+
+def paginate(query, order_by, page_size=100, cursor=None, connection=None, descending=False):
+    """
+    fetches the page of query that follows cursor, ordered by the order_by keys
+
+    the page is found with a WHERE on the keys instead of an OFFSET, so with an
+    index on them any page costs the same; the keys must identify a row, so end
+    them with the primary key; they replace any ORDER BY of query, which the
+    WHERE would not match
+
+        page = paginate(session.query(Customers), [Customers.id])
+        page = paginate(session.query(Customers), [Customers.id], cursor=page.cursor)
+
+    :param query: ORM Query, or Core select executed on connection
+    :param order_by: columns, mapped attributes or labeled expressions selected by query
+    :param page_size:
+    :param cursor: Page.cursor of the previous page, None for the first one
+    :param connection: needed for Core selects
+    :param descending:
+    :return: Page(rows, cursor), cursor is None on the last page
+    """
+    keys = list(order_by)
+    if cursor is not None:
+        condition = after(keys, decode_cursor(cursor, len(keys)), descending)
+        query = query.filter(condition) if isinstance(query, Query) else query.where(condition)
+
+    query = query.order_by(None).order_by(*[key.desc() if descending else key for key in keys]).limit(page_size + 1)
+    rows = query.all() if isinstance(query, Query) else connection.execute(query).all()
+
+    if len(rows) <= page_size:
+        return Page(rows, None)
+    rows = rows[:page_size]
+    return Page(rows, encode_cursor([key_value(rows[-1], key) for key in keys]))
+
+
+def pages(query, order_by, page_size=100, connection=None, descending=False):
+    """
+    iterates over all the pages of query
+
+    :param query:
+    :param order_by:
+    :param page_size:
+    :param connection:
+    :param descending:
+    :return: generator of Page
+    """
+    cursor = None
+    while True:
+        page = paginate(query, order_by, page_size, cursor, connection, descending)
+        yield page
+        if page.cursor is None:
+            return
+        cursor = page.cursor
@@ -0,0 +1,160 @@
+"""
+process level read-through cache of primary key lookups on declarative models
+"""
+import collections
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+
+
+class PrimaryKeyCache:
+    """
+    LRU of maxsize rows, each valid for ttl seconds, shared by all sessions
+
+    only the column attributes are cached; a hit builds the object in the
+    session without touching the database. Once installed, rows are invalidated
+    when a session flushes or commits changes to them, and any UPDATE/DELETE
+    statement run on the engine (Query.update/delete, mutations.bulk_update,
+    Core) invalidates every cached row of its table; sql strings, as
+    exec_driver_sql, and writes of other processes are not seen
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.rows = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.flushing = {}      # Connection: Session of the flushes in progress, which invalidate by identity
+
+    def get(self, session, entity, key):
+        """
+        session.get(entity, key) going to the database only on a cache miss
+
+        :param session:
+        :param entity: mapped class
+        :param key: primary key
+        :return: the instance or None
+        """
+        identity = identity_key(entity, key)
+        obj = session.identity_map.get(identity)
+        if obj is not None:
+            return obj
+
+        now = time.monotonic()
+        with self.lock:
+            cached = self.rows.get(identity)
+            if cached is not None and cached[0] > now:
+                self.rows.move_to_end(identity)
+                self.hits += 1
+                values = cached[1]
+            else:
+                self.misses += 1
+                values = None
+
+        if values is not None:
+            obj = sqlalchemy.inspect(entity).class_manager.new_instance()
+            for name, value in values.items():
+                set_committed_value(obj, name, value)
+            make_transient_to_detached(obj)
+            session.add(obj)
+            return obj
+
+        obj = session.get(entity, key)
+        if obj is not None:
+            self.put(identity, obj)
+        return obj
+
+    def put(self, identity, obj):
+        mapper = sqlalchemy.inspect(obj).mapper
+        values = {prop.key: getattr(obj, prop.key) for prop in mapper.column_attrs}
+        with self.lock:
+            self.rows[identity] = (time.monotonic() + self.ttl, values)
+            self.rows.move_to_end(identity)
+            while len(self.rows) > self.maxsize:
+                self.rows.popitem(last=False)
+
+    def invalidate(self, identities):
+        with self.lock:
+            for identity in identities:
+                self.rows.pop(identity, None)
+
+    def invalidate_class(self, entity):
+        with self.lock:
+            for identity in [identity for identity in self.rows if issubclass(identity[0], entity)]:
+                del self.rows[identity]
+
+    def invalidate_table(self, table):
+        with self.lock:
+            for identity in [
+                identity for identity in self.rows if table in sqlalchemy.inspect(identity[0]).tables
+            ]:
+                del self.rows[identity]
+
+    def clear(self):
+        with self.lock:
+            self.rows.clear()
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hits / lookups if lookups else 0.0,
+            size=len(self.rows),
+            maxsize=self.maxsize,
+        )
+
+    #
+    #   session and engine events
+    #
+    def install(self, target, engine=sqlalchemy.engine.Engine):
+        """
+        listens on target, a Session, a sessionmaker or the Session class, and on engine
+
+        :param target:
+        :param engine: Engine, or the Engine class for all of them
+        :return: self
+        """
+        sqlalchemy.event.listen(target, "before_flush", self.before_flush)
+        sqlalchemy.event.listen(target, "after_flush", self.after_flush)
+        sqlalchemy.event.listen(target, "after_commit", self.after_end)
+        sqlalchemy.event.listen(target, "after_soft_rollback", self.after_end)
+        sqlalchemy.event.listen(engine, "after_execute", self.after_execute)
+        return self
+
+    def before_flush(self, session, flush_context, instances):
+        if session.dirty or session.deleted:
+            self.flushing[session.connection()] = session
+
+    def after_flush(self, session, flush_context):
+        self.flushing.pop(session.connection(), None)
+        changed = [
+            sqlalchemy.inspect(obj).key
+            for obj in list(session.dirty) + list(session.deleted)
+            if sqlalchemy.inspect(obj).key is not None
+        ]
+        self.invalidate(changed)
+        # again at the end of the transaction, other sessions may have
+        # cached the committed rows in between
+        session.info.setdefault("pkcache_flushed", set()).update(changed)
+
+    def after_end(self, session, *args):
+        # a failed flush has no after_flush
+        for connection, flushing_session in list(self.flushing.items()):
+            if flushing_session is session:
+                del self.flushing[connection]
+        self.invalidate(session.info.pop("pkcache_flushed", ()))
+
+    def after_execute(self, conn, clauseelement, multiparams, params, execution_options, result):
+        # ORM bulk and Core statements alike, the session is not involved with the latter
+        if conn in self.flushing:
+            return
+        if isinstance(clauseelement, (sqlalchemy.sql.Update, sqlalchemy.sql.Delete)):
+            self.invalidate_table(clauseelement.table)
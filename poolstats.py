@@ -0,0 +1,176 @@
+"""
+connection pool instrumentation: checkout wait and hold times, usage, leaks
+"""
+import collections
+import logging
+import time
+import traceback
+import warnings
+
+import sqlalchemy
+
+import common
+
+logger = logging.getLogger(__name__)
+
+WAIT_INFO = "poolstats_wait"    # connection record info key of the checkout wait
+
+
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    """
+    QueuePool recording how long each checkout waited for a connection in the
+    info of its connection record, read by PoolMonitor in the checkout event
+
+    this overrides the private QueuePool._do_get: no pool event fires before a
+    checkout starts waiting, so the wait cannot be measured with events alone;
+    it relies on SQLAlchemy internals and may need updating on upgrades.
+    engine.dispose() recreates the pool with the same class
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        record = super()._do_get()
+        record.info[WAIT_INFO] = time.perf_counter() - start
+        return record
+
+
+def pool_options(size=5, overflow=10, timeout=30, pre_ping=False, recycle=-1, lifo=False):
+    """
+    create_engine keyword arguments for a QueuePool, its checkout waits timed,
+    its sqlite connections usable by any thread that checks them out
+
+        engine = main.create_engine(**pool_options(size=10, pre_ping=True))
+
+    :param size: connections kept open
+    :param overflow: connections opened above size under load
+    :param timeout: seconds to wait for a connection before giving up
+    :param pre_ping: test connections on checkout
+    :param recycle: seconds after which a connection is replaced, -1 never
+    :param lifo: reuse the most recent connection, letting the others idle
+    :return:
+    """
+    return dict(
+        poolclass=TimedQueuePool,
+        pool_size=size,
+        max_overflow=overflow,
+        pool_timeout=timeout,
+        pool_pre_ping=pre_ping,
+        pool_recycle=recycle,
+        pool_use_lifo=lifo,
+    )
+
+
+class LongHeldConnectionWarning(UserWarning):
+    pass
+
+
+class PoolMonitor:
+    """
+    records checkout wait times, hold times and connections in use of an engine pool
+
+    a connection held longer than hold_warning seconds warns when it is checked in,
+    leaks() lists the ones still checked out since longer than that
+
+    it listens to the pool events of the engine, which carry over to the new pool
+    of engine.dispose(); wait times need a TimedQueuePool, see pool_options
+    """
+
+    def __init__(self, engine, hold_warning=5.0, samples=10000, capture_stacks=False):
+        self.engine = engine
+        self.hold_warning = hold_warning
+        self.capture_stacks = capture_stacks
+        self.waits = collections.deque(maxlen=samples)
+        self.holds = collections.deque(maxlen=samples)
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.peak_in_use = 0
+        self.long_held = 0
+        self.checked_out = {}   # connection record: (checkout time, stack)
+
+        sqlalchemy.event.listen(engine, "connect", self.connect)
+        sqlalchemy.event.listen(engine, "checkout", self.checkout)
+        sqlalchemy.event.listen(engine, "checkin", self.checkin)
+
+    def remove(self):
+        sqlalchemy.event.remove(self.engine, "connect", self.connect)
+        sqlalchemy.event.remove(self.engine, "checkout", self.checkout)
+        sqlalchemy.event.remove(self.engine, "checkin", self.checkin)
+
+    @property
+    def pool(self):
+        # the current one, engine.dispose() replaces it
+        return self.engine.pool
+
+    @property
+    def in_use(self):
+        return len(self.checked_out)
+
+    def connect(self, dbapi_connection, connection_record):
+        self.connects += 1
+
+    def checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checkouts += 1
+        wait = connection_record.info.pop(WAIT_INFO, None)
+        if wait is not None:
+            self.waits.append(wait)
+        stack = traceback.format_stack(limit=12)[:-2] if self.capture_stacks else None
+        self.checked_out[connection_record] = (time.perf_counter(), stack)
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def checkin(self, dbapi_connection, connection_record):
+        checked_out = self.checked_out.pop(connection_record, None)
+        if checked_out is None:
+            return
+        self.checkins += 1
+        held = time.perf_counter() - checked_out[0]
+        self.holds.append(held)
+        if held > self.hold_warning:
+            self.long_held += 1
+            warnings.warn(f"connection held for {held:.1f}s", LongHeldConnectionWarning,
+                          stacklevel=common.user_stacklevel(__file__))
+
+    def leaks(self):
+        """
+        connections checked out since more than hold_warning seconds
+
+        :return: list of (seconds held, checkout stack or None)
+        """
+        now = time.perf_counter()
+        return [
+            (now - start, stack)
+            for start, stack in self.checked_out.values()
+            if now - start > self.hold_warning
+        ]
+
+    def log_leaks(self):
+        for held, stack in self.leaks():
+            logger.warning(f"connection checked out since {held:.1f}s" + ("\n" + "".join(stack) if stack else ""))
+
+    @staticmethod
+    def summary(values):
+        if not values:
+            return dict(count=0, mean=0.0, p99=0.0, max=0.0)
+        ordered = sorted(values)
+        return dict(
+            count=len(ordered),
+            mean=sum(ordered) / len(ordered),
+            p99=ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))],
+            max=ordered[-1],
+        )
+
+    @property
+    def stats(self):
+        overflow = self.pool.overflow() if hasattr(self.pool, "overflow") else None
+        return dict(
+            pool=self.pool.status(),
+            connects=self.connects,
+            checkouts=self.checkouts,
+            checkins=self.checkins,
+            in_use=self.in_use,
+            peak_in_use=self.peak_in_use,
+            overflow=overflow,
+            long_held=self.long_held,
+            wait=self.summary(self.waits),
+            hold=self.summary(self.holds),
+        )
@@ -0,0 +1,94 @@
+"""
+registry of named statements, compiled once per dialect and executed by name
+"""
+import collections
+
+import sqlalchemy
+
+
+def text(sql, **types):
+    """
+    text() with typed bind parameters
+
+    :param sql:
+    :param types: bind parameter name = sqlalchemy type
+    :return:
+    """
+    statement = sqlalchemy.sql.text(sql)
+    if types:
+        statement = statement.bindparams(
+            *[sqlalchemy.bindparam(key, type_=type_) for key, type_ in types.items()]
+        )
+    return statement
+
+
+class PreparedQueries:
+    """
+    named statements with typed bind parameters
+
+    the compiled form of each (name, dialect) is kept in an LRU of maxsize entries,
+    so executing a query by name skips building, cache keying and compiling the statement
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.statements = {}
+        self.compiled = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def define(self, name, statement, types=None):
+        """
+        registers statement under name, replacing any previous definition
+
+        :param name:
+        :param statement: sql string, typed by types, or any executable statement
+                          (build its text fragments with text() to type them)
+        :param types: dict of bind parameter name: sqlalchemy type
+        :return: the registered statement
+        """
+        if isinstance(statement, str):
+            statement = text(statement, **(types or {}))
+        elif types:
+            raise sqlalchemy.exc.ArgumentError("types can only be given along with a sql string")
+        self.statements[name] = statement
+        for key in [key for key in self.compiled if key[0] == name]:
+            del self.compiled[key]
+        return statement
+
+    def get(self, name, dialect):
+        """
+        returns the compiled statement name for dialect
+
+        :param name:
+        :param dialect:
+        :return:
+        """
+        key = (name, dialect.name, dialect.paramstyle)
+        try:
+            compiled = self.compiled[key]
+        except KeyError:
+            self.misses += 1
+            compiled = self.statements[name].compile(dialect=dialect)
+            self.compiled[key] = compiled
+            if len(self.compiled) > self.maxsize:
+                self.compiled.popitem(last=False)
+        else:
+            self.hits += 1
+            self.compiled.move_to_end(key)
+        return compiled
+
+    def execute(self, connection, name, params=None):
+        """
+        executes the query name on connection
+
+        :param connection:
+        :param name:
+        :param params: dict of bind parameter values
+        :return:
+        """
+        return connection.execute(self.get(name, connection.dialect), params or {})
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self.compiled), maxsize=self.maxsize)
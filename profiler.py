@@ -0,0 +1,297 @@
+"""
+slow query profiler: per normalized statement count, total/mean/p99 time and
+rows, with the EXPLAIN QUERY PLAN of the ones slower than a threshold
+
+    profiler = QueryProfiler(threshold=0.01).install(engine)
+    ...
+    profiler.top(10)
+    profiler.export_json("queries.json")
+    profiler.export_folded("queries.folded")   # flamegraph.pl / speedscope input
+
+or, on every engine of a script left untouched:
+
+    python profiler.py main_declarative.py --json queries.json --folded queries.folded
+"""
+import collections
+import json
+import os
+import re
+import sys
+import threading
+
+import common
+
+SAMPLES = 1000      # durations kept per statement for the percentiles
+EXPLAINABLE = ("select", "with", "insert", "update", "delete")
+
+NORMALIZE = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),                           # string literals
+    (re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b"), "?"),              # number literals
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), "(?, ...)"),        # IN lists, VALUES rows
+    (re.compile(r"(?:\(\?, \.\.\.\)\s*,\s*)+\(\?, \.\.\.\)"), "(?, ...), ..."),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def normalize(statement):
+    """
+    statement with literals replaced by ? and IN lists of any length folded
+
+    :param statement:
+    :return:
+    """
+    for pattern, replacement in NORMALIZE:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+class CountingCursor:
+    """
+    DBAPI cursor proxy counting the rows fetched through it, under the lock of the profiler
+    """
+    __slots__ = ("cursor", "stats", "lock")
+
+    def __init__(self, cursor, stats, lock):
+        self.cursor = cursor
+        self.stats = stats
+        self.lock = lock
+
+    def count(self, rows):
+        with self.lock:
+            self.stats.rows += rows
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.count(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self.count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.count(len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class QueryStats:
+    def __init__(self, statement):
+        self.statement = statement
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.samples = collections.deque(maxlen=SAMPLES)
+        self.plan = None        # EXPLAIN QUERY PLAN of the first execution over threshold, () while it runs
+        self.slow = 0
+        self.stacks = collections.Counter()     # folded stack: seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def as_dict(self):
+        return dict(
+            statement=self.statement,
+            count=self.count,
+            total=self.total,
+            mean=self.mean,
+            p99=self.percentile(0.99),
+            max=self.max,
+            rows=self.rows,
+            slow=self.slow,
+            plan=self.plan,
+        )
+
+
+class QueryProfiler(common.CursorTimer):
+    """
+    aggregates the cursor executions of one engine, or of all of them when
+    installed on the Engine class
+
+    count_rows proxies the cursor of the statements returning rows so that the
+    fetched ones are counted, statements that do not return rows count their rowcount;
+    capture_stacks records the calling python frames outside sqlalchemy, for
+    export_folded, at the cost of a stack walk per execution
+    """
+
+    def __init__(self, threshold=0.1, count_rows=True, capture_stacks=False, max_statements=5000):
+        self.threshold = threshold
+        self.count_rows = count_rows
+        self.capture_stacks = capture_stacks
+        self.max_statements = max_statements
+        self.statements = {}    # normalized statement: QueryStats
+        self.normalized = {}    # statement: normalized statement
+        self.lock = threading.Lock()
+
+    #
+    #   events
+    #
+    def timed(self, conn, cursor, statement, parameters, context, executemany, elapsed):
+        normalized = self.normalized.get(statement)
+        if normalized is None:
+            normalized = normalize(statement)
+
+        explain = False
+        with self.lock:
+            if len(self.normalized) < self.max_statements:
+                self.normalized.setdefault(statement, normalized)
+            stats = self.statements.get(normalized)
+            if stats is None:
+                if len(self.statements) >= self.max_statements:
+                    return
+                stats = self.statements[normalized] = QueryStats(normalized)
+            stats.count += 1
+            stats.total += elapsed
+            stats.max = max(stats.max, elapsed)
+            stats.samples.append(elapsed)
+            if self.capture_stacks:
+                stats.stacks[self.stack()] += elapsed
+            if cursor.description is None:
+                stats.rows += max(cursor.rowcount, 0)
+            if elapsed >= self.threshold:
+                stats.slow += 1
+                if stats.plan is None and not executemany and statement.lstrip()[:6].lower().startswith(EXPLAINABLE):
+                    # claimed, the other threads do not explain it too
+                    stats.plan = ()
+                    explain = True
+
+        if cursor.description is not None and self.count_rows and context is not None:
+            # the result is built from context.cursor after this event
+            context.cursor = CountingCursor(cursor, stats, self.lock)
+
+        if explain:
+            # outside the lock, it runs a statement
+            plan = self.explain(conn, statement, parameters)
+            with self.lock:
+                stats.plan = plan
+
+    @staticmethod
+    def explain(conn, statement, parameters):
+        # on a raw DBAPI cursor, so that it is not profiled itself
+        try:
+            cursor = conn.connection.cursor()
+            try:
+                cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+                return [row[3] for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+        except Exception as e:
+            return [f"EXPLAIN failed: {e}"]
+
+    @staticmethod
+    def stack():
+        """
+        folded calling frames, outermost first, sqlalchemy and this module left out
+        """
+        frames = []
+        # past timed() and CursorTimer.after_cursor_execute
+        frame = sys._getframe(3)
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if f"{os.sep}sqlalchemy{os.sep}" not in filename and filename != __file__ and filename[0] != "<":
+                frames.append(f"{os.path.basename(filename)}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(frames))
+
+    #
+    #   runtime queries
+    #
+    def stats(self):
+        """
+        :return: list of per statement dicts, by total time, slowest first
+        """
+        with self.lock:
+            return sorted((stats.as_dict() for stats in self.statements.values()), key=lambda s: -s["total"])
+
+    def top(self, n=10, key="total"):
+        return sorted(self.stats(), key=lambda s: -s[key])[:n]
+
+    def slow(self):
+        return [stats for stats in self.stats() if stats["slow"]]
+
+    def reset(self):
+        with self.lock:
+            self.statements.clear()
+
+    #
+    #   exports
+    #
+    def export_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump(dict(threshold=self.threshold, statements=self.stats()), f, indent=4)
+
+    def folded(self):
+        """
+        lines of "frame;frame;...;statement microseconds", the input of flamegraph.pl and speedscope;
+        without captured stacks the frames are the statement verb
+
+        :return: list of str
+        """
+        lines = []
+        with self.lock:
+            for stats in self.statements.values():
+                leaf = stats.statement.replace(";", ",")
+                if stats.stacks:
+                    for stack, seconds in stats.stacks.items():
+                        lines.append(f"{stack};{leaf} {int(seconds * 1e6)}")
+                else:
+                    verb = leaf.split(" ", 1)[0].upper()
+                    lines.append(f"{verb};{leaf} {int(stats.total * 1e6)}")
+        return lines
+
+    def export_folded(self, filename):
+        with open(filename, "w") as f:
+            f.write("\n".join(self.folded()) + "\n")
+
+    def report(self, n=10, out=None):
+        out = out or sys.stdout
+        for stats in self.top(n):
+            print(
+                f"{stats['count']:6d}x total={stats['total'] * 1000:9.3f}ms mean={stats['mean'] * 1000:8.3f}ms "
+                f"p99={stats['p99'] * 1000:8.3f}ms rows={stats['rows']:<8d} | {stats['statement'][:100]}",
+                file=out
+            )
+            for detail in stats["plan"] or ():
+                print(f"{'':10s}plan: {detail}", file=out)
+
+
+if __name__ == '__main__':
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description="profiles the queries of every engine a script creates")
+    parser.add_argument("script")
+    parser.add_argument("--threshold", type=float, default=0.01, help="seconds above which the plan is captured")
+    parser.add_argument("--stacks", action="store_true", help="capture the python call stacks, for --folded")
+    parser.add_argument("--json")
+    parser.add_argument("--folded")
+    parser.add_argument("--top", type=int, default=10)
+    args, script_args = parser.parse_known_args()
+
+    profiler = QueryProfiler(threshold=args.threshold, capture_stacks=args.stacks).install()
+    sys.argv = [args.script] + script_args
+    try:
+        runpy.run_path(args.script, run_name="__main__")
+    finally:
+        print("#" * 80, file=sys.stderr)
+        profiler.report(args.top, out=sys.stderr)
+        if args.json:
+            profiler.export_json(args.json)
+        if args.folded:
+            profiler.export_folded(args.folded)
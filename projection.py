@@ -0,0 +1,161 @@
+"""
+lightweight reads of the declarative models: plain namedtuple records, or
+column batches, built from the Result rows with no identity map, no
+instance state and no attribute instrumentation
+
+    for customer in read(session, Customers, Customers.id != 2):
+        print(customer.name)
+
+    for batch in read_columns(session, Customers, columns=("id", "email")):
+        print(batch["email"])
+"""
+import collections
+
+import sqlalchemy
+
+_record_classes = {}
+
+
+def record_class(model, columns=None):
+    """
+    namedtuple with the model columns, or columns, as fields, one class per model and columns
+
+    :param model:
+    :param columns: column names, default all the table columns
+    :return:
+    """
+    columns = tuple(columns or model.__table__.columns.keys())
+    key = (model, columns)
+    record = _record_classes.get(key)
+    if record is None:
+        record = _record_classes[key] = collections.namedtuple(f"{model.__name__}Record", columns)
+    return record
+
+
+def _select(model, columns, criteria, order_by):
+    table = model.__table__
+    statement = sqlalchemy.select(*[table.c[column] for column in columns])
+    if criteria:
+        statement = statement.where(*criteria)
+    if order_by is not None:
+        statement = statement.order_by(order_by)
+    return statement
+
+
+def _partitions(bind, statement, chunk_size):
+    """
+    lists of up to chunk_size Rows, fetched chunk_size at a time
+
+    :param bind: Session or Connection
+    :param statement:
+    :param chunk_size:
+    :return: iterator of lists
+    """
+    result = bind.execute(statement.execution_options(yield_per=chunk_size))
+    try:
+        yield from result.partitions(chunk_size)
+    finally:
+        result.close()
+
+
+def read(bind, model, *criteria, columns=None, order_by=None, chunk_size=1000):
+    """
+    rows of model as namedtuples, see record_class
+
+    :param bind: Session, Connection or Engine
+    :param model: declarative class
+    :param criteria: where clauses, on model attributes
+    :param columns: column names, default all the table columns
+    :param order_by:
+    :param chunk_size: rows fetched at a time
+    :return: iterator of records
+    """
+    record = record_class(model, columns)
+    statement = _select(model, record._fields, criteria, order_by)
+    if isinstance(bind, sqlalchemy.engine.Engine):
+        with bind.connect() as connection:
+            yield from read(connection, model, *criteria, columns=columns, order_by=order_by, chunk_size=chunk_size)
+        return
+
+    make = record._make
+    for rows in _partitions(bind, statement, chunk_size):
+        yield from map(make, rows)
+
+
+def read_columns(bind, model, *criteria, columns=None, order_by=None, chunk_size=1000):
+    """
+    rows of model as column batches, {column name: list of values} for
+    each chunk_size rows
+
+    :param bind: Session, Connection or Engine
+    :param model: declarative class
+    :param criteria: where clauses, on model attributes
+    :param columns: column names, default all the table columns
+    :param order_by:
+    :param chunk_size: rows per batch
+    :return: iterator of dicts
+    """
+    names = tuple(columns or model.__table__.columns.keys())
+    statement = _select(model, names, criteria, order_by)
+    if isinstance(bind, sqlalchemy.engine.Engine):
+        with bind.connect() as connection:
+            yield from read_columns(connection, model, *criteria, columns=columns, order_by=order_by,
+                                    chunk_size=chunk_size)
+        return
+
+    for rows in _partitions(bind, statement, chunk_size):
+        yield dict(zip(names, map(list, zip(*rows))))
+
+
+if __name__ == '__main__':
+    import argparse
+    import gc
+    import os
+    import shutil
+    import tempfile
+    import time
+    import tracemalloc
+
+    from sqlalchemy.orm import sessionmaker
+
+    import common
+    import fixtures
+    from models import Customers
+
+    parser = argparse.ArgumentParser(description="per row memory and time of full entities against lightweight reads")
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="projection-")
+    filename = fixtures.clone("bench", os.path.join(directory, "bench.db"), args.rows)
+    engine = common.create_sqlite_engine(filename, profile=common.PROFILE_READ_HEAVY)
+    Session = sessionmaker(bind=engine)
+
+    modes = dict(
+        entities=lambda session: session.query(Customers).all(),
+        columns_query=lambda session: session.query(
+            Customers.id, Customers.name, Customers.address, Customers.email
+        ).all(),
+        records=lambda session: list(read(session, Customers)),
+        column_batches=lambda session: list(read_columns(session, Customers, chunk_size=args.rows)),
+    )
+    try:
+        for name, f in modes.items():
+            with Session() as session:
+                f(session)   # warm up: compiled statement caches, sqlite page cache
+            with Session() as session:
+                start = time.perf_counter()
+                f(session)
+                elapsed = time.perf_counter() - start
+            # memory apart, tracemalloc slows allocations down
+            with Session() as session:
+                gc.collect()
+                tracemalloc.start()
+                kept = f(session)
+                size, _ = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                del kept
+            print(f"{name:<15s} {elapsed / args.rows * 1e6:7.2f}us/row {size / args.rows:8.1f}B/row")
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
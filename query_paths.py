@@ -0,0 +1,184 @@
+########################################################################################################################
+# runs the same logical query through every path shown in main.py and main_declarative.py:
+# Core Table, text(), ORM entity, ORM columns and ORM Bundle, with a per phase time breakdown
+#
+#   python query_paths.py --rows 100000 --repeat 10
+########################################################################################################################
+import argparse
+import shutil
+import statistics
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy.future import select
+from sqlalchemy.orm import Bundle
+
+import benchmark
+import common
+from models import Customers
+
+PHASES = ("prepare", "execute", "rows")
+
+
+class Timeline:
+    """
+    marks the cursor execution boundaries of the statements run by engine
+    """
+
+    def __init__(self, engine):
+        self.before = self.after = None
+        sqlalchemy.event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        sqlalchemy.event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def before_cursor_execute(self, *args):
+        self.before = time.perf_counter()
+
+    def after_cursor_execute(self, *args):
+        self.after = time.perf_counter()
+
+
+def customer_columns():
+    return Customers.id, Customers.name, Customers.address, Customers.email
+
+
+#
+#   each path builds a statement for a where clause and returns (statement, runner),
+#   runner executes the statement on a session and returns a not yet consumed result
+#
+def core_path(criteria):
+    table = Customers.__table__
+    statement = table.select().where(*criteria(table.c))
+    return statement, lambda session: session.connection().execute(statement)
+
+
+def text_path(criteria):
+    table = Customers.__table__
+    sql = table.select().where(*criteria(table.c)).compile(compile_kwargs=dict(literal_binds=True))
+    statement = sqlalchemy.sql.text(str(sql))
+    return statement, lambda session: session.connection().execute(statement)
+
+
+def orm_entity_path(criteria):
+    statement = select(Customers).where(*criteria(Customers))
+    return statement, lambda session: session.execute(statement).scalars()
+
+
+def orm_columns_path(criteria):
+    statement = select(*customer_columns()).where(*criteria(Customers))
+    return statement, lambda session: session.execute(statement)
+
+
+def orm_bundle_path(criteria):
+    statement = select(Bundle("customer", *customer_columns())).where(*criteria(Customers))
+    return statement, lambda session: session.execute(statement)
+
+
+PATHS = {
+    "core": core_path,
+    "text": text_path,
+    "orm_entity": orm_entity_path,
+    "orm_columns": orm_columns_path,
+    "orm_bundle": orm_bundle_path,
+}
+
+#
+#   logical queries, as where clauses over the Customers columns
+#
+QUERIES = {
+    "select_all": lambda columns: (),
+    "select_where": lambda columns: (columns.id > 2,),
+    "select_like": lambda columns: (columns.name.like("%e1%"),),
+}
+
+
+def measure(engine, Session, path, criteria, repeat):
+    """
+    runs a path repeat times, each one in a new session so the identity map starts empty
+
+    compile is the cold compile of the statement, the other phases are medians:
+    prepare until the cursor executes (cache lookup, parameters), execute in the driver,
+    rows to fetch and build every row (ORM instances and identity map included)
+
+    :param engine:
+    :param Session:
+    :param path:
+    :param criteria:
+    :param repeat:
+    :return: dict of phase timings
+    """
+    statement, runner = PATHS[path](criteria)
+    start = time.perf_counter()
+    statement.compile(dialect=engine.dialect)
+    compiled = time.perf_counter() - start
+
+    timeline = Timeline(engine)
+    phases = {phase: [] for phase in PHASES}
+    try:
+        for _ in range(repeat):
+            with Session() as session:
+                session.connection()
+                start = time.perf_counter()
+                result = runner(session)
+                returned = time.perf_counter()
+                count = len(result.all())
+                consumed = time.perf_counter()
+            phases["prepare"].append(timeline.before - start)
+            phases["execute"].append(timeline.after - timeline.before)
+            phases["rows"].append(consumed - returned)
+    finally:
+        sqlalchemy.event.remove(engine, "before_cursor_execute", timeline.before_cursor_execute)
+        sqlalchemy.event.remove(engine, "after_cursor_execute", timeline.after_cursor_execute)
+
+    timings = {phase: statistics.median(values) for phase, values in phases.items()}
+    timings["compile"] = compiled
+    timings["total"] = sum(timings[phase] for phase in PHASES)
+    timings["count"] = count
+    return timings
+
+
+def compare_paths(engine, Session, query, repeat=10):
+    """
+    measures every path for query; orm_entity gets an extra "identity" figure, its rows
+    time minus the orm_columns one, that is the cost of building and tracking instances
+
+    :param engine:
+    :param Session:
+    :param query: name in QUERIES
+    :param repeat:
+    :return: {path: timings}
+    """
+    criteria = QUERIES[query]
+    results = {path: measure(engine, Session, path, criteria, repeat) for path in PATHS}
+    results["orm_entity"]["identity"] = results["orm_entity"]["rows"] - results["orm_columns"]["rows"]
+    return results
+
+
+def print_comparison(query, results):
+    print(f"{query}:")
+    for path, timings in sorted(results.items(), key=lambda item: item[1]["total"]):
+        identity = f" identity={timings['identity'] * 1000:8.3f}ms" if "identity" in timings else ""
+        print(
+            f"  {path:<12s} rows={timings['count']:<8d} total={timings['total'] * 1000:8.3f}ms "
+            f"compile={timings['compile'] * 1000:7.3f}ms prepare={timings['prepare'] * 1000:7.3f}ms "
+            f"execute={timings['execute'] * 1000:8.3f}ms rows={timings['rows'] * 1000:8.3f}ms{identity}"
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="compare the Core, text() and ORM paths of the same query")
+    parser.add_argument("--query", action="append", choices=sorted(QUERIES), help="default: all")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--profile", choices=sorted(common.ENGINE_PROFILES), default=common.PROFILE_READ_HEAVY)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="paths-")
+    bench = benchmark.Bench(directory, args.rows, args.repeat, args.profile)
+    try:
+        bench.seed()
+        for name in args.query or QUERIES:
+            print_comparison(name, compare_paths(bench.engine, bench.Session, name, args.repeat))
+    finally:
+        bench.close()
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,264 @@
+"""
+opt-in cache of query results, keyed by compiled sql and bound parameters
+"""
+import collections
+import sys
+import threading
+
+import sqlalchemy
+from sqlalchemy.orm.loading import merge_frozen_result
+from sqlalchemy.sql.util import find_tables
+
+ANY_TABLE = "*"     # reads that cannot be analyzed, like text(), depend on every table
+WRITE_VERBS = ("insert", "update", "delete", "replace")
+
+
+def estimate_size(rows):
+    """
+    rough size in bytes of frozen rows, ORM instances included
+
+    :param rows:
+    :return:
+    """
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row if isinstance(row, (tuple, sqlalchemy.engine.Row)) else (row,):
+            size += sys.getsizeof(value)
+            if hasattr(value, "__dict__"):
+                size += sum(sys.getsizeof(attribute) for attribute in vars(value).values())
+    return size
+
+
+class ResultCache:
+    """
+    frozen results of selects, evicted least recently used first above max_bytes
+
+    Core selects go through execute(), ORM queries opt in with
+    .execution_options(result_cache=True) on a session the cache is installed on.
+    Once installed on an engine, any insert/update/delete run by it drops the
+    cached results of the tables it writes, and DDL or unparsed sql drops them all
+
+    a result is stored only if no invalidation of its tables happened while it
+    was read, and a connection with uncommitted writes to its tables neither
+    reads nor stores it, so other connections are never served that view
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_statements=500):
+        self.max_bytes = max_bytes
+        self.max_statements = max_statements
+        self.results = collections.OrderedDict()  # key: (tables, size, frozen)
+        self.compiled = collections.OrderedDict()  # statement cache key: (compiled, tables)
+        self.generations = collections.Counter()  # table name: invalidations, ANY_TABLE included
+        self.generation = 0  # invalidations of any table
+        self.bytes = 0
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def key(self, statement, dialect, params=None):
+        """
+        (sql, bound parameters) of statement, compiling it once per cache key
+
+        :param statement:
+        :param dialect:
+        :param params:
+        :return: (key, tables) or (None, None) if the statement is not cacheable
+        """
+        cache_key = statement._generate_cache_key()
+        if cache_key is None:
+            return None, None
+
+        with self.lock:
+            entry = self.compiled.get((cache_key.key, dialect.name))
+            if entry is None:
+                entry = statement.compile(dialect=dialect, cache_key=cache_key), self.tables(statement)
+                self.compiled[(cache_key.key, dialect.name)] = entry
+                if len(self.compiled) > self.max_statements:
+                    self.compiled.popitem(last=False)
+            else:
+                self.compiled.move_to_end((cache_key.key, dialect.name))
+
+        compiled, tables = entry
+        bound = compiled.construct_params(params, extracted_parameters=cache_key[1])
+        # expanding IN parameters are lists
+        bound = tuple(sorted((name, tuple(value) if isinstance(value, list) else value) for name, value in bound.items()))
+        return (compiled.string, bound), tables
+
+    @staticmethod
+    def tables(statement):
+        if isinstance(statement, sqlalchemy.sql.expression.TextClause):
+            return frozenset([ANY_TABLE])
+        names = frozenset(table.name for table in find_tables(statement, include_joins=True, include_aliases=True)
+                          if isinstance(table, sqlalchemy.Table))
+        textual = any(isinstance(element, sqlalchemy.sql.expression.TextClause)
+                      for element in getattr(statement, "_raw_columns", ()))
+        return names | {ANY_TABLE} if textual or not names else names
+
+    def get(self, key):
+        with self.lock:
+            entry = self.results.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.results.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def stamp(self, tables):
+        """
+        token that changes whenever the results depending on tables are invalidated
+
+        :param tables: table names
+        :return:
+        """
+        with self.lock:
+            if ANY_TABLE in tables:
+                return self.generation
+            return tuple(self.generations[table] for table in sorted(tables)) + (self.generations[ANY_TABLE],)
+
+    @staticmethod
+    def written(connection, tables):
+        """
+        whether connection has uncommitted writes the results of tables depend on
+        """
+        written = connection.info.get("result_cache_written")
+        if not written:
+            return False
+        return ANY_TABLE in written or ANY_TABLE in tables or not written.isdisjoint(tables)
+
+    def put(self, key, tables, frozen, stamp=None):
+        """
+        stores frozen, unless stamp, see stamp(), is not current anymore
+
+        :param key:
+        :param tables:
+        :param frozen:
+        :param stamp: taken before the statement was executed
+        :return:
+        """
+        size = estimate_size(frozen.data)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if stamp is not None and stamp != self.stamp(tables):
+                # invalidated while it was read, the rows may be stale already
+                return
+            previous = self.results.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self.results[key] = (tables, size, frozen)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted, _) = self.results.popitem(last=False)
+                self.bytes -= evicted
+
+    def execute(self, connection, statement, params=None):
+        """
+        connection.execute(statement, params), served from the cache when possible
+
+        :param connection:
+        :param statement:
+        :param params:
+        :return: a Result
+        """
+        key, tables = self.key(statement, connection.dialect, params)
+        if key is None or self.written(connection, tables):
+            return connection.execute(statement, params or {})
+
+        frozen = self.get(key)
+        if frozen is None:
+            stamp = self.stamp(tables)
+            frozen = connection.execute(statement, params or {}).freeze()
+            self.put(key, tables, frozen, stamp)
+        return frozen()
+
+    def invalidate(self, tables):
+        """
+        drops the results depending on any of tables, ANY_TABLE drops everything
+
+        :param tables: table names
+        :return:
+        """
+        with self.lock:
+            self.generation += 1
+            self.generations.update(tables)
+            if ANY_TABLE in tables:
+                dropped = list(self.results)
+            else:
+                dropped = [key for key, entry in self.results.items() if entry[0] & tables or ANY_TABLE in entry[0]]
+            for key in dropped:
+                self.bytes -= self.results.pop(key)[1]
+            self.invalidations += len(dropped)
+
+    def clear(self):
+        self.invalidate({ANY_TABLE})
+
+    @property
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            invalidations=self.invalidations,
+            size=len(self.results),
+            bytes=self.bytes,
+            max_bytes=self.max_bytes,
+        )
+
+    #
+    #   events
+    #
+    def install(self, engine, session=None):
+        """
+        listens for writes on engine and, if given, for cached ORM queries on session,
+        a Session, a sessionmaker or the Session class
+
+        :param engine:
+        :param session:
+        :return: self
+        """
+        sqlalchemy.event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+        sqlalchemy.event.listen(engine, "commit", self.end)
+        sqlalchemy.event.listen(engine, "rollback", self.end)
+        if session is not None:
+            sqlalchemy.event.listen(session, "do_orm_execute", self.do_orm_execute)
+        return self
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context.isinsert or context.isupdate or context.isdelete:
+            table = getattr(context.compiled.statement, "table", None)
+            tables = {table.name} if isinstance(table, sqlalchemy.Table) else {ANY_TABLE}
+        elif context.isddl or statement.lstrip()[:7].lower().startswith(WRITE_VERBS):
+            # DDL, and writes from text() or exec_driver_sql()
+            tables = {ANY_TABLE}
+        else:
+            return
+        self.invalidate(tables)
+        # again at the end of the transaction, other connections may have
+        # cached the rows it was changing in between
+        conn.info.setdefault("result_cache_written", set()).update(tables)
+
+    def end(self, conn):
+        written = conn.info.pop("result_cache_written", None)
+        if written:
+            self.invalidate(written)
+
+    def do_orm_execute(self, orm_execute_state):
+        if not orm_execute_state.is_select or not orm_execute_state.execution_options.get("result_cache"):
+            return None
+
+        session = orm_execute_state.session
+        dialect = session.get_bind(mapper=orm_execute_state.bind_mapper).dialect
+        key, tables = self.key(orm_execute_state.statement, dialect, orm_execute_state.parameters)
+        if key is None:
+            return None
+        if self.written(session.connection(bind_arguments=orm_execute_state.bind_arguments), tables):
+            return None
+
+        frozen = self.get(key)
+        if frozen is None:
+            stamp = self.stamp(tables)
+            frozen = orm_execute_state.invoke_statement().freeze()
+            self.put(key, tables, frozen, stamp)
+        return merge_frozen_result(session, orm_execute_state.statement, frozen, load=False)()
@@ -0,0 +1,231 @@
+"""
+sqlite FTS5 full text search over the text columns of a table, ranked by bm25
+
+the index is an external content table: it stores only the tokens, the rows
+stay in the indexed table and triggers keep the two in sync, Core bulk
+writes included
+
+    CUSTOMERS.create(engine)                                    # once, on an existing db
+    CUSTOMERS.search(session, Customers, "robb")                # Customers entities, best first
+    CUSTOMERS.search(connection, Customers.__table__, "castig") # Rows
+"""
+import sqlalchemy
+
+from models import Customers
+
+TOKENIZE_TRIGRAM = "trigram"                            # substrings of 3 characters or more, like LIKE '%...%'
+TOKENIZE_WORDS = "unicode61 remove_diacritics 2"        # words and word prefixes, with prefix=True
+TRIGRAM = 3
+TRIGRAM_VERSION = (3, 34)                               # first sqlite with the trigram tokenizer
+
+
+class FullTextIndex:
+    """
+    FTS5 index named <table>_fts on columns of table, which needs an integer primary key
+    """
+
+    def __init__(self, table, columns, tokenize=TOKENIZE_TRIGRAM):
+        self.table = table
+        self.columns = tuple(columns)
+        self.tokenize = tokenize
+        self.name = f"{table.name}_fts"
+        self.key = list(table.primary_key.columns)[0]
+        self.fts = sqlalchemy.table(self.name, sqlalchemy.column("rowid"), *map(sqlalchemy.column, self.columns))
+
+    def ddl(self):
+        """
+        statements creating the index and its triggers, if they do not exist
+        """
+        columns = ", ".join(self.columns)
+        new = ", ".join(f"new.{column}" for column in self.columns)
+        old = ", ".join(f"old.{column}" for column in self.columns)
+        delete = f"INSERT INTO {self.name}({self.name}, rowid, {columns}) VALUES ('delete', old.{self.key.name}, {old});"
+        insert = f"INSERT INTO {self.name}(rowid, {columns}) VALUES (new.{self.key.name}, {new});"
+        return [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.name} USING fts5("
+            f"{columns}, content='{self.table.name}', content_rowid='{self.key.name}', tokenize='{self.tokenize}')",
+            f"CREATE TRIGGER IF NOT EXISTS {self.name}_ai AFTER INSERT ON {self.table.name} BEGIN {insert} END",
+            f"CREATE TRIGGER IF NOT EXISTS {self.name}_ad AFTER DELETE ON {self.table.name} BEGIN {delete} END",
+            f"CREATE TRIGGER IF NOT EXISTS {self.name}_au AFTER UPDATE OF {columns} ON {self.table.name} "
+            f"BEGIN {delete} {insert} END",
+        ]
+
+    def check(self, connection):
+        """
+        raises ValueError if the sqlite of connection lacks the tokenizer, instead of
+        the "no such tokenizer" of the CREATE VIRTUAL TABLE
+
+        :param connection:
+        :return:
+        """
+        version = connection.dialect.server_version_info
+        if self.tokenize == TOKENIZE_TRIGRAM and version < TRIGRAM_VERSION:
+            raise ValueError(
+                f"the {TOKENIZE_TRIGRAM} tokenizer needs sqlite {'.'.join(map(str, TRIGRAM_VERSION))} or later, "
+                f"this is {'.'.join(map(str, version))}: use TOKENIZE_WORDS"
+            )
+
+    def create(self, bind):
+        """
+        creates the index on an existing database and indexes its rows
+
+        :param bind: Engine, or Connection in a transaction
+        :return:
+        """
+        if isinstance(bind, sqlalchemy.engine.Engine):
+            with bind.begin() as connection:
+                return self.create(connection)
+        self.check(bind)
+        for statement in self.ddl():
+            bind.exec_driver_sql(statement)
+        self.rebuild(bind)
+
+    def rebuild(self, connection):
+        # reindexes every row, after writes made with the triggers missing
+        connection.exec_driver_sql(f"INSERT INTO {self.name}({self.name}) VALUES ('rebuild')")
+
+    def attach(self):
+        """
+        creates the index, and drops it, with the table in metadata.create_all/drop_all
+
+        :return: self
+        """
+        sqlalchemy.event.listen(self.table, "before_create", lambda target, connection, **kw: self.check(connection))
+        for statement in self.ddl():
+            sqlalchemy.event.listen(self.table, "after_create", sqlalchemy.DDL(statement))
+        sqlalchemy.event.listen(self.table, "before_drop", sqlalchemy.DDL(f"DROP TABLE IF EXISTS {self.name}"))
+        return self
+
+    @staticmethod
+    def phrase(text, prefix=False):
+        """
+        text as one FTS5 phrase, its quotes escaped and, with prefix, matching word prefixes
+
+        :param text:
+        :param prefix:
+        :return:
+        """
+        return '"' + text.replace('"', '""') + '"' + ("*" if prefix else "")
+
+    def statement(self, entity, text, columns=None, prefix=False, limit=None):
+        """
+        select of entity matching text, best bm25 rank first
+
+        trigram indexes cannot match fewer than 3 characters: shorter text
+        falls back to LIKE '%text%' on the columns, a full scan, in key order
+
+        :param entity: model or table, of the indexed table
+        :param text: searched text
+        :param columns: indexed columns to search, default all
+        :param prefix: word prefix search, for TOKENIZE_WORDS
+        :param limit:
+        :return:
+        """
+        columns = tuple(columns or self.columns)
+        statement = sqlalchemy.select(entity)
+        if self.tokenize == TOKENIZE_TRIGRAM and len(text) < TRIGRAM:
+            statement = statement.where(
+                sqlalchemy.or_(*[self.table.c[column].contains(text, autoescape=True) for column in columns])
+            ).order_by(self.key)
+        else:
+            query = self.phrase(text, prefix)
+            if columns != self.columns:
+                query = "{" + " ".join(columns) + "} : " + query
+            match = sqlalchemy.literal_column(self.name)
+            statement = statement.join(self.fts, self.fts.c.rowid == self.key).where(
+                match.op("MATCH")(query)
+            ).order_by(sqlalchemy.func.bm25(match))
+        return statement.limit(limit) if limit is not None else statement
+
+    def search(self, bind, entity, text, columns=None, prefix=False, limit=20):
+        """
+        entities (for a Session and a model) or rows matching text, best first
+
+        :param bind: Session, Connection or Engine
+        :param entity: model or table, of the indexed table
+        :param text:
+        :param columns: indexed columns to search, default all
+        :param prefix: word prefix search, for TOKENIZE_WORDS
+        :param limit:
+        :return: list
+        """
+        statement = self.statement(entity, text, columns, prefix, limit)
+        if isinstance(bind, sqlalchemy.orm.Session):
+            result = bind.execute(statement)
+            return result.scalars().all() if not isinstance(entity, sqlalchemy.Table) else result.all()
+        if isinstance(bind, sqlalchemy.engine.Engine):
+            with bind.connect() as connection:
+                return connection.execute(statement).all()
+        return bind.execute(statement).all()
+
+
+CUSTOMERS = FullTextIndex(Customers.__table__, ("name", "address", "email"))
+
+
+def college_indexes(students, addresses, tokenize=TOKENIZE_TRIGRAM):
+    """
+    indexes of the main.py tables, which are defined per MetaData
+
+    :param students:
+    :param addresses:
+    :param tokenize:
+    :return: (students index, addresses index)
+    """
+    return (
+        FullTextIndex(students, ("name", "lastname"), tokenize),
+        FullTextIndex(addresses, ("postal_add", "email_add"), tokenize),
+    )
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import shutil
+    import tempfile
+    import time
+
+    from sqlalchemy.orm import sessionmaker
+
+    import common
+    import fixtures
+
+    parser = argparse.ArgumentParser(description="FTS5 search against LIKE scans on the customers")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="search-")
+    filename = fixtures.clone("bench", os.path.join(directory, "bench.db"), args.rows)
+    engine = common.create_sqlite_engine(filename, profile=common.PROFILE_READ_HEAVY)
+    try:
+        start = time.perf_counter()
+        CUSTOMERS.create(engine)
+        print(f"index built in {time.perf_counter() - start:.2f}s")
+
+        with sessionmaker(bind=engine)() as session:
+            for text in ("name1234", "reet 9999", "99@mail"):
+                like = session.query(Customers).filter(Customers.email.like(f"%{text}%") | Customers.name.like(
+                    f"%{text}%") | Customers.address.like(f"%{text}%"))
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    found = like.limit(20).all()
+                scan = (time.perf_counter() - start) / args.repeat
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    ranked = CUSTOMERS.search(session, Customers, text)
+                fts = (time.perf_counter() - start) / args.repeat
+                print(
+                    f"{text!r:12s} like={scan * 1000:8.3f}ms ({len(found)}) fts={fts * 1000:8.3f}ms ({len(ranked)}) "
+                    f"best={ranked[0].name if ranked else None}"
+                )
+
+            customer = Customers(name="Fab", address="meow street 9", email="fab@meow.com")
+            session.add(customer)
+            session.commit()
+            print("after insert:", [c.email for c in CUSTOMERS.search(session, Customers, "meow")])
+            customer.address = "purr avenue"
+            session.commit()
+            print("after update:", [c.address for c in CUSTOMERS.search(session, Customers, "purr", columns=("address",))])
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
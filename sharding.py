@@ -0,0 +1,301 @@
+"""
+horizontal sharding over N sqlite files: rows are routed by a hash of their key,
+bulk loads run one writer process per shard, reads fan out and merge
+
+    shards = ShardSet("sales.db", 4)
+    shards.create_all(Base.metadata)
+    shards.load(Customers.__table__, rows)
+    shards.get(Customers.__table__, 42)
+    shards.query(select(Customers).order_by(Customers.name).limit(10), order_by="name", limit=10)
+"""
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import operator
+import os
+import time
+import zlib
+
+import sqlalchemy
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import sessionmaker
+
+import bootstrap
+import common
+import fixtures
+import main
+from models import Base, Customers
+
+LoadReport = collections.namedtuple("LoadReport", "rows elapsed rows_per_second shards")
+
+
+def shard_of(key, shards):
+    """
+    stable across processes and runs, unlike hash()
+
+    :param key:
+    :param shards: number of shards
+    :return: shard number
+    """
+    return zlib.crc32(repr(key).encode()) % shards
+
+
+#
+#   process pool side: one engine per shard file and worker process
+#
+_engines = {}
+
+
+def _load_shard(filename, profile, table_name, rows, chunk_size, method):
+    engine = _engines.get(filename)
+    if engine is None:
+        engine = _engines[filename] = common.create_sqlite_engine(filename, profile=profile)
+    table = sqlalchemy.Table(table_name, sqlalchemy.MetaData(), autoload_with=engine)
+    start = time.perf_counter()
+    main.bulk_insert(engine, table, rows, chunk_size, method)
+    return len(rows), time.perf_counter() - start
+
+
+class ShardSet:
+    """
+    N sqlite files sharing one schema, filename "sales.db" gives "sales_0.db" ... "sales_<N-1>.db"
+
+    every row lives on the shard of its primary key, which must be unique across
+    shards: rows loaded without one get the next id of the whole set
+    """
+
+    def __init__(self, filename, shards, profile=common.PROFILE_READ_HEAVY, load_profile=common.PROFILE_BULK_LOAD):
+        base, extension = os.path.splitext(filename)
+        self.filenames = [f"{base}_{n}{extension}" for n in range(shards)]
+        self.profile = profile
+        self.load_profile = load_profile
+        self.engines = [
+            # fan out threads share the pools: check_same_thread is off for QueuePool profiles
+            common.create_sqlite_engine(name, profile=profile)
+            for name in self.filenames
+        ]
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=shards)
+        self.next_ids = {}  # table name: itertools.count
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def shard_of(self, key):
+        return shard_of(key, len(self))
+
+    def reset(self):
+        self.close()
+        for filename in self.filenames:
+            common.resetdb(filename, seed="empty")
+
+    def close(self):
+        for engine in self.engines:
+            engine.dispose()
+
+    def create_all(self, metadata):
+        for engine in self.engines:
+            bootstrap.ensure_schema(engine, metadata)
+
+    def allocate(self, table, count=1):
+        """
+        ids not used on any shard, for rows inserted without a primary key
+
+        :param table:
+        :param count:
+        :return: list of ids
+        """
+        counter = self.next_ids.get(table.name)
+        if counter is None:
+            column = self.key_column(table)
+            last = max(rows[0][0] or 0 for rows in self.fan_out(sqlalchemy.select(sqlalchemy.func.max(column))))
+            counter = self.next_ids[table.name] = itertools.count(last + 1)
+        return list(itertools.islice(counter, count))
+
+    @staticmethod
+    def key_column(table):
+        columns = list(table.primary_key.columns)
+        if len(columns) != 1:
+            raise ValueError(f"{table.name}: sharding needs a single column primary key")
+        return columns[0]
+
+    #
+    #   writes
+    #
+    def load(self, table, rows, processes=None, batch_size=50000, chunk_size=10000, method=main.BULK_EXECUTEMANY):
+        """
+        routes rows (any iterable of dicts) to their shard and inserts them with one
+        writer process per shard, at most batch_size rows per shard are held in memory
+
+        :param table:
+        :param rows:
+        :param processes: default: one per shard, up to the number of cores
+        :param batch_size: rows sent to a worker at a time
+        :param chunk_size: rows per transaction, see main.bulk_insert
+        :param method: see main.bulk_insert
+        :return: LoadReport
+        """
+        key = self.key_column(table).name
+        buffers = [[] for _ in self.filenames]
+        pending = {}  # shard: future, never more than one writer per shard
+        loaded = [0] * len(self)
+        processes = processes or min(len(self), os.cpu_count() or 1)
+
+        start = time.perf_counter()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+
+            def collect(shard):
+                future = pending.pop(shard, None)
+                if future is not None:
+                    loaded[shard] += future.result()[0]
+
+            def submit(shard):
+                collect(shard)
+                pending[shard] = executor.submit(
+                    _load_shard, self.filenames[shard], self.load_profile, table.name, buffers[shard], chunk_size, method
+                )
+                buffers[shard] = []
+
+            for row in rows:
+                if row.get(key) is None:
+                    row = dict(row, **{key: self.allocate(table)[0]})
+                shard = self.shard_of(row[key])
+                buffers[shard].append(row)
+                if len(buffers[shard]) >= batch_size:
+                    submit(shard)
+
+            for shard, buffer in enumerate(buffers):
+                if buffer:
+                    submit(shard)
+            for shard in list(pending):
+                collect(shard)
+        elapsed = time.perf_counter() - start
+
+        # ids loaded explicitly may be above the allocated ones
+        self.next_ids.pop(table.name, None)
+        total = sum(loaded)
+        return LoadReport(total, elapsed, total / elapsed if elapsed else float("inf"), loaded)
+
+    #
+    #   reads
+    #
+    def fan_out(self, statement, params=None, shards=None):
+        """
+        runs statement on every shard, or on shards, concurrently
+
+        :param statement:
+        :param params:
+        :param shards: shard numbers, default all
+        :return: one list of rows per shard
+        """
+        def run(engine):
+            with engine.connect() as connection:
+                return connection.execute(statement, params or {}).all()
+
+        engines = self.engines if shards is None else [self.engines[shard] for shard in shards]
+        return list(self.executor.map(run, engines))
+
+    def query(self, statement, params=None, order_by=None, reverse=False, limit=None):
+        """
+        fan_out() with the results merged: the statement should already be ordered by
+        the order_by columns (and limited, then limit applies again after the merge)
+
+        :param statement:
+        :param params:
+        :param order_by: column name, or tuple of names, the per shard results are sorted by
+        :param reverse: True for a descending order_by
+        :param limit:
+        :return: list of rows
+        """
+        results = self.fan_out(statement, params)
+        if order_by is None:
+            rows = itertools.chain.from_iterable(results)
+        else:
+            names = (order_by,) if isinstance(order_by, str) else tuple(order_by)
+            rows = heapq.merge(*results, key=operator.attrgetter(*names), reverse=reverse)
+        return list(itertools.islice(rows, limit))
+
+    def get(self, table, key):
+        """
+        the row of table with primary key key, read from its shard only
+
+        :param table:
+        :param key:
+        :return: Row or None
+        """
+        statement = table.select().where(self.key_column(table) == key)
+        rows = self.fan_out(statement, shards=[self.shard_of(key)])[0]
+        return rows[0] if rows else None
+
+    def count(self, table, *criteria):
+        statement = sqlalchemy.select(sqlalchemy.func.count()).select_from(table).where(*criteria)
+        return sum(rows[0][0] for rows in self.fan_out(statement))
+
+    #
+    #   ORM
+    #
+    def sessionmaker(self, **kwargs):
+        """
+        sessions whose get() reads one shard, queries read all of them and new
+        or changed objects are flushed to the shard of their primary key,
+        which must be set, see allocate()
+
+        :param kwargs: passed to sessionmaker
+        :return:
+        """
+        def shard_chooser(mapper, instance, clause=None):
+            if instance is None:
+                # statements with no instance behind them, as session.execute(text(...)), run on the first shard
+                return "0"
+            key = mapper.primary_key_from_instance(instance)
+            if None in key:
+                raise ValueError(f"{instance!r} has no primary key, allocate() one before adding it")
+            return str(self.shard_of(key[0]))
+
+        def id_chooser(query, ident):
+            return [str(self.shard_of(ident[0]))]
+
+        def execute_chooser(orm_context):
+            return [str(shard) for shard in range(len(self))]
+
+        return sessionmaker(
+            class_=ShardedSession,
+            shard_chooser=shard_chooser,
+            id_chooser=id_chooser,
+            execute_chooser=execute_chooser,
+            shards={str(shard): engine for shard, engine in enumerate(self.engines)},
+            **kwargs
+        )
+
+
+if __name__ == '__main__':
+    import argparse
+    import shutil
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="sharded bulk load throughput")
+    parser.add_argument("--rows", type=int, default=400000)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    for count in args.shards:
+        directory = tempfile.mkdtemp(prefix="shards-")
+        shard_set = ShardSet(os.path.join(directory, "sales.db"), count)
+        try:
+            shard_set.create_all(Base.metadata)
+            report = shard_set.load(Customers.__table__, fixtures.customer_rows(args.rows))
+            print(f"shards={count:<3d} rows={report.rows} rows/s={report.rows_per_second:>10.1f} per shard={report.shards}")
+
+            table = Customers.__table__
+            print("  count:", shard_set.count(table), "get(42):", shard_set.get(table, 42))
+            top = sqlalchemy.select(table).order_by(table.c.name).limit(3)
+            print("  first names:", [row.name for row in shard_set.query(top, order_by="name", limit=3)])
+            with shard_set.sessionmaker()() as session:
+                customer = session.get(Customers, 7)
+                customer.name = "sharded"
+                session.add(Customers(id=shard_set.allocate(table)[0], name="new", address="here", email="new@mail.com"))
+                session.commit()
+                print("  orm:", session.query(Customers).filter(Customers.name.in_(["sharded", "new"])).all())
+        finally:
+            shard_set.close()
+            shutil.rmtree(directory, ignore_errors=True)
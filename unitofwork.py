@@ -0,0 +1,310 @@
+"""
+high volume inserts of ORM objects: buffered, flushed in chunks of batched
+INSERTs and expunged once written, so that the identity map stays small
+"""
+import collections
+import itertools
+import time
+
+import sqlalchemy
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY
+
+ChunkReport = collections.namedtuple("ChunkReport", "chunk objects elapsed objects_per_second")
+
+METHOD_CORE = "core"    # one executemany INSERT per table and set of columns, no unit of work
+METHOD_ORM = "orm"      # session.add_all() and flush() per chunk, the unit of work as usual
+
+KEYS_AUTO = "auto"              # RETURNING when the dialect returns keys from executemany, else KEYS_ASSIGN
+KEYS_RETURNING = "returning"    # the database generates the keys, INSERT ... RETURNING reads them back
+KEYS_ASSIGN = "assign"          # keys counted up from max(pk), read again at every flush
+
+
+class BulkWriter:
+    """
+    buffers new objects, and the new objects related to them, and inserts them
+    chunk_size at a time; foreign keys are filled from the related objects, as
+    Invoice.custid from Invoice.customer or from Customers.invoices
+
+    METHOD_CORE skips the ORM flush events (before_insert, ...), engine
+    events and database triggers still run
+
+        with BulkWriter(session, chunk_size=10000, report=print) as writer:
+            for row in rows:
+                customer = Customers(**row)
+                customer.invoices = [Invoice(invno=1, amount=10)]
+                writer.add(customer)
+        session.commit()
+    """
+
+    def __init__(self, session, chunk_size=10000, method=METHOD_CORE, keys=KEYS_AUTO, expunge=True, report=None):
+        self.session = session
+        self.chunk_size = chunk_size
+        self.method = method
+        self.expunge = expunge
+        self.report = report
+        if keys == KEYS_AUTO:
+            dialect = session.get_bind().dialect
+            keys = KEYS_RETURNING if getattr(dialect, "insert_executemany_returning", False) else KEYS_ASSIGN
+        self.keys = keys
+        self.pending = []       # objects, their states only hold them weakly
+        self.buffered = set()   # id() of the pending objects
+        self.plans = {}         # mapper: _MapperPlan
+        self.reports = []
+        self.chunks = itertools.count(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, obj):
+        """
+        buffers obj with the transient objects reachable from it, flushing a
+        chunk once chunk_size objects are pending
+
+        :param obj:
+        :return:
+        """
+        buffered, pending = self.buffered, self.pending
+        stack = [obj]
+        while stack:
+            obj = stack.pop()
+            if id(obj) in buffered:
+                continue
+            state = sqlalchemy.inspect(obj)
+            if not state.transient:
+                continue
+            buffered.add(id(obj))
+            pending.append(obj)
+            values = state.dict
+            for key, uselist in self._plan(state.mapper).relationships:
+                related = values.get(key)
+                if related is None:
+                    continue
+                if uselist:
+                    stack.extend(related)
+                else:
+                    stack.append(related)
+
+        if len(pending) >= self.chunk_size:
+            self.flush()
+
+    def add_all(self, objects):
+        for obj in objects:
+            self.add(obj)
+
+    def flush(self):
+        """
+        writes the pending objects
+
+        :return: ChunkReport, or None when nothing was pending
+        """
+        if not self.pending:
+            return None
+
+        objects, self.pending, self.buffered = self.pending, [], set()
+        start = time.perf_counter()
+        if self.method == METHOD_ORM:
+            self._flush_orm(objects)
+        elif self.method == METHOD_CORE:
+            self._flush_core(objects)
+        else:
+            raise ValueError(f"unknown method: {self.method!r}")
+        elapsed = time.perf_counter() - start
+
+        chunk_report = ChunkReport(next(self.chunks), len(objects), elapsed,
+                                   len(objects) / elapsed if elapsed else float("inf"))
+        self.reports.append(chunk_report)
+        if self.report is not None:
+            self.report(chunk_report)
+        return chunk_report
+
+    #
+    #   METHOD_ORM
+    #
+    def _flush_orm(self, objects):
+        self.session.add_all(objects)
+        self.session.flush()
+        if self.expunge:
+            for obj in objects:
+                self.session.expunge(obj)
+
+    #
+    #   METHOD_CORE
+    #
+    def _plan(self, mapper):
+        plan = self.plans.get(mapper)
+        if plan is None:
+            plan = self.plans[mapper] = _MapperPlan(mapper)
+        return plan
+
+    def _flush_core(self, objects):
+        connection = self.session.connection()
+        by_table = collections.defaultdict(list)
+        for obj in objects:
+            state = sqlalchemy.inspect(obj)
+            by_table[state.mapper.local_table].append(state)
+
+        # parents first
+        metadata = next(iter(by_table)).metadata
+        order = {table: n for n, table in enumerate(metadata.sorted_tables)}
+        for table in sorted(by_table, key=lambda table: order.get(table, len(order))):
+            table_states = by_table[table]
+            self._copy_from_parents(table_states)
+            if self.keys == KEYS_ASSIGN:
+                self._assign_keys(connection, table, table_states)
+            self._insert(connection, table, table_states)
+            self._copy_to_children(table_states)
+
+        for obj in objects:
+            make_transient_to_detached(obj)
+            if not self.expunge:
+                self.session.add(obj)
+
+    def _assign_keys(self, connection, table, states):
+        # rows written by other sessions since the previous chunk are seen, the
+        # rows they write while this chunk is inserted are not: one writer at a time
+        primary_key, = table.primary_key.columns
+        last = connection.execute(sqlalchemy.select(sqlalchemy.func.max(primary_key))).scalar()
+        counter = itertools.count((last or 0) + 1)
+        for state in states:
+            key = self._plan(state.mapper).primary_key
+            values = state.dict
+            if values.get(key) is None:
+                values[key] = next(counter)
+
+    def _insert(self, connection, table, states):
+        # one statement per set of columns, objects may leave different attributes unset
+        by_columns = collections.defaultdict(list)
+        for state in states:
+            values = state.dict
+            row = {column: values[key] for key, column in self._plan(state.mapper).columns if key in values}
+            by_columns[tuple(sorted(row))].append((state, row))
+
+        primary_key, = table.primary_key.columns
+        for columns, rows in by_columns.items():
+            insert = table.insert()
+            if self.keys == KEYS_RETURNING and primary_key.key not in columns:
+                insert = insert.returning(primary_key)
+                result = connection.execute(insert, [row for state, row in rows])
+                for (state, row), (key,) in zip(rows, result):
+                    state.dict[self._plan(state.mapper).primary_key] = key
+            else:
+                connection.execute(insert, [row for state, row in rows])
+
+    def _copy_from_parents(self, states):
+        # many to one: the foreign key of each state from its parent, inserted already
+        for state in states:
+            values = state.dict
+            for key, pairs in self._plan(state.mapper).many_to_one:
+                parent = values.get(key)
+                if parent is None:
+                    continue
+                parent_values = sqlalchemy.inspect(parent).dict
+                for local, remote in pairs:
+                    value = parent_values.get(remote)
+                    if value is not None:
+                        values[local] = value
+
+    def _copy_to_children(self, states):
+        # one to many: the foreign key of the children of each state, not inserted yet
+        for state in states:
+            values = state.dict
+            for key, pairs in self._plan(state.mapper).one_to_many:
+                children = values.get(key)
+                if not children:
+                    continue
+                for child in children:
+                    child_state = sqlalchemy.inspect(child)
+                    if not child_state.transient:
+                        continue
+                    child_values = child_state.dict
+                    for local, remote in pairs:
+                        child_values[remote] = values.get(local)
+
+
+class _MapperPlan:
+    """
+    attribute keys of a mapper, resolved once per BulkWriter instead of once per object
+    """
+
+    def __init__(self, mapper):
+        self.relationships = [(r.key, r.uselist) for r in mapper.relationships]
+        self.columns = [(prop.key, prop.columns[0].key) for prop in mapper.column_attrs]
+        primary_key = mapper.local_table.primary_key.columns
+        self.primary_key = mapper.get_property_by_column(list(primary_key)[0]).key if len(primary_key) == 1 else None
+        # (relationship key, [(attribute key on this side, attribute key on the other side)])
+        self.many_to_one = []
+        self.one_to_many = []
+        for relationship in mapper.relationships:
+            if relationship.direction is MANYTOONE:
+                self.many_to_one.append((relationship.key, [
+                    (mapper.get_property_by_column(local).key, relationship.mapper.get_property_by_column(remote).key)
+                    for local, remote in relationship.local_remote_pairs
+                ]))
+            elif relationship.direction is ONETOMANY:
+                self.one_to_many.append((relationship.key, [
+                    (mapper.get_property_by_column(local).key, relationship.mapper.get_property_by_column(remote).key)
+                    for local, remote in relationship.local_remote_pairs
+                ]))
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import shutil
+    import tempfile
+
+    from sqlalchemy.orm import sessionmaker
+
+    import common
+    import fixtures
+    from models import Customers, Invoice
+
+    parser = argparse.ArgumentParser(description="add_all() and commit against chunked flushes")
+    parser.add_argument("--customers", type=int, default=50000)
+    parser.add_argument("--invoices", type=int, default=3, help="per customer")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    def objects():
+        for row in fixtures.customer_rows(args.customers):
+            customer = Customers(**row)
+            customer.invoices = [Invoice(invno=n, amount=n * 100) for n in range(args.invoices)]
+            yield customer
+
+    def plain(session):
+        session.add_all(list(objects()))
+        session.commit()
+        return ""
+
+    def chunked(method):
+        def run(session):
+            with BulkWriter(session, args.chunk_size, method) as writer:
+                writer.add_all(objects())
+            session.commit()
+            return f" {len(writer.reports)} chunks, slowest {max(r.elapsed for r in writer.reports):.3f}s"
+        return run
+
+    directory = tempfile.mkdtemp(prefix="unitofwork-")
+    try:
+        for name, run in (("add_all", plain), (METHOD_ORM, chunked(METHOD_ORM)), (METHOD_CORE, chunked(METHOD_CORE))):
+            filename = fixtures.clone("empty", os.path.join(directory, "sales.db"))
+            engine = common.create_sqlite_engine(filename, profile=common.PROFILE_BULK_LOAD)
+            with sessionmaker(bind=engine)() as session:
+                start = time.perf_counter()
+                note = run(session)
+                elapsed = time.perf_counter() - start
+                total = args.customers * (1 + args.invoices)
+                orphans = session.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(
+                    Invoice.__table__).where(Invoice.custid.is_(None))).scalar()
+                print(
+                    f"{name:<8s} {elapsed:7.2f}s {total / elapsed:10.1f} objects/s "
+                    f"identity map={len(session.identity_map)} invoices without custid={orphans}{note}"
+                )
+            engine.dispose()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)